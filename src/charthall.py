@@ -16,6 +16,10 @@
 
 
 import os
+import shutil
+import signal
+import socket
+import tempfile
 import waitress
 import charthall_py
 import paste.translogger
@@ -30,25 +34,124 @@ if __name__ == "__main__":
     if port is None:
         port=8080
 
-    waitress.serve(
-        paste.translogger.TransLogger(
-            charthall_py.create_app(                
-                _storage_local_rootdir=os.getenv('STORAGE_LOCAL_ROOTDIR'),
-                _chart_post_form_field_name=os.getenv('CHART_POST_FORM_FIELD_NAME'),
-                _prov_post_form_field_name=os.getenv('PROV_POST_FORM_FIELD_NAME'),
-                _basic_auth_user=os.getenv('BASIC_AUTH_USER'),
-                _basic_auth_pass=os.getenv('BASIC_AUTH_PASS'),
-                _auth_anonymous_get=os.getenv('AUTH_ANONYMOUS_GET'),
-                _allow_overwrite=os.getenv('ALLOW_OVERWRITE'),
-                _chart_url=os.getenv('CHART_URL'),
-                _cache_interval=os.getenv('CACHE_INTERVAL'),
-                _index_limit=os.getenv('INDEX_LIMIT'),
-        #do not do anything
-                _storage=os.getenv('STORAGE'),   #ALWAYS =LOCAL             
-                _depth=os.getenv('DEPTH')        #ALWAYS =1
+    workers=os.getenv('WORKERS')
+    if workers is None:
+        workers=1
+
+    shared_root=os.getenv('SHARED_DIR')
+    if shared_root is None and os.path.isdir('/dev/shm'):
+        shared_root='/dev/shm'
+
+    options={
+        '_storage_local_rootdir': os.getenv('STORAGE_LOCAL_ROOTDIR'),
+        '_chart_post_form_field_name': os.getenv('CHART_POST_FORM_FIELD_NAME'),
+        '_prov_post_form_field_name': os.getenv('PROV_POST_FORM_FIELD_NAME'),
+        '_basic_auth_user': os.getenv('BASIC_AUTH_USER'),
+        '_basic_auth_pass': os.getenv('BASIC_AUTH_PASS'),
+        '_auth_anonymous_get': os.getenv('AUTH_ANONYMOUS_GET'),
+        '_allow_overwrite': os.getenv('ALLOW_OVERWRITE'),
+        '_chart_url': os.getenv('CHART_URL'),
+        '_cache_interval': os.getenv('CACHE_INTERVAL'),
+        '_index_limit': os.getenv('INDEX_LIMIT'),
+        '_snapshot': os.getenv('SNAPSHOT'),
+        '_digest_memory_limit': os.getenv('DIGEST_MEMORY_LIMIT'),
+        '_render_delay': os.getenv('RENDER_DELAY'),
+        '_index_streaming': os.getenv('INDEX_STREAMING'),
+        '_watch': os.getenv('WATCH'),
+        '_watch_delay': os.getenv('WATCH_DELAY'),
+        '_follow_leader': os.getenv('FOLLOW_LEADER'),
+        '_follow_user': os.getenv('FOLLOW_USER'),
+        '_follow_pass': os.getenv('FOLLOW_PASS'),
+        '_follow_interval': os.getenv('FOLLOW_INTERVAL'),
+        '_journal_size': os.getenv('JOURNAL_SIZE'),
+        '_server_timing': os.getenv('SERVER_TIMING'),
+        '_profiler': os.getenv('PROFILER'),
+        '_lazy_load': os.getenv('LAZY_LOAD'),
+        '_load_timeout': os.getenv('LOAD_TIMEOUT'),
+        '_page_limit': os.getenv('PAGE_LIMIT'),
+        '_fsync': os.getenv('FSYNC'),
+        '_fragment_cache': os.getenv('FRAGMENT_CACHE'),
+    #do not do anything
+        '_storage': os.getenv('STORAGE'),   #ALWAYS =LOCAL
+        '_depth': os.getenv('DEPTH')        #ALWAYS =1
+    }
+
+    if int(workers) <= 1:
+        waitress.serve(
+            paste.translogger.TransLogger(
+                charthall_py.create_app(**options)
+            ),
+            port=port,
+            host="0.0.0.0",
+            url_prefix=context_path
+        )
+    else:
+        #writer process keeps the cache and handles all changes on unix socket,
+        #read workers share listening socket and serve published index documents
+        shared_dir=tempfile.mkdtemp(prefix='charthall-', dir=shared_root)
+        writer_socket=os.path.join(shared_dir, 'writer.sock')
+
+        sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', int(port)))
+        sock.listen(1024)
+
+        children=[]
+        for i in range(int(workers)):
+            pid=os.fork()
+            if pid == 0:
+                waitress.serve(
+                    paste.translogger.TransLogger(
+                        charthall_py.create_reader_app(
+                            _shared_dir=shared_dir,
+                            _writer_socket=writer_socket,
+                            **options
+                        )
+                    ),
+                    sockets=[ sock ],
+                    url_prefix=context_path
+                )
+                os._exit(0)
+
+            children.append(pid)
+
+        sock.close()
+
+        def cleanup():
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+            #published documents would stay in memory backed /dev/shm
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+        def stop(_signum, _frame):
+            cleanup()
+            os._exit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        try:
+            waitress.serve(
+                paste.translogger.TransLogger(
+                    charthall_py.create_app(
+                        _shared_dir=shared_dir,
+                        _writer_socket=writer_socket,
+                        **options
+                    )
+                ),
+                unix_socket=writer_socket,
+                unix_socket_perms='600',
+                url_prefix=context_path
             )
-        ),
-        port=port,
-        host="0.0.0.0",
-        url_prefix=context_path
-    )
+        finally:
+            cleanup()
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Rafal Prasal <rafal.prasal@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import contextlib
+import datetime
+import gzip
+import http.client
+import io
+import json
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import charthall_py
+
+BENCH_REPOS=1
+BENCH_CHARTS=20
+BENCH_VERSIONS=10
+BENCH_SIZE=16*1024
+BENCH_POSTS=200
+BENCH_REQUESTS=200
+BENCH_DOWNLOADS=200
+BENCH_CONCURRENCY=[ 1, 100 ]
+BENCH_INDEX_LIMIT=50
+BENCH_ENCODING='gzip'
+BENCH_DIR=None
+BENCH_OUTPUT=None
+BENCH_SEED=0
+
+BENCH_STARTUP_TIMEOUT=3600
+BENCH_MARKER='.charthall-bench.json'
+
+def log_print(_type, _msg):
+    #stdout is left for results
+    print(
+        '[{stamp}] [{type}] {msg}'.format(
+            stamp=datetime.datetime.now().strftime("%d/%b/%Y:%H:%M:%S +0000"),
+            type=_type,
+            msg=_msg
+        ),
+        file=sys.stderr
+    )
+
+################ DATASET ################
+def chart_tgz(_chart, _version, _size, _pool, _rnd):
+    #valid chart archive, padding is taken from a random pool so that
+    #every file has its own digest and does not compress
+    offset=_rnd.randrange(0, len(_pool)-_size+1)
+
+    chart_yaml="""apiVersion: v1
+name: {chart}
+version: {version}
+description: {chart} {version}
+""".format(chart=_chart, version=_version).encode('utf-8')
+
+    buffer=io.BytesIO()
+
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for name, data in [
+            (_chart+'/Chart.yaml', chart_yaml),
+            (_chart+'/files/padding', _pool[offset:offset+_size])
+        ]:
+            info=tarfile.TarInfo(name)
+            info.size=len(data)
+            info.mtime=0
+            tar.addfile(info, io.BytesIO(data))
+
+    return gzip.compress(buffer.getvalue(), compresslevel=1, mtime=0)
+
+def chart_version(_i):
+    return '{major}.{minor}.{patch}'.format(
+        major=_i//100,
+        minor=(_i//10)%10,
+        patch=_i%10
+    )
+
+def dataset_files(_params):
+    #files generated for params, relative to the dataset root
+    files=[]
+
+    for r in range(_params['repos']):
+        for c in range(_params['charts']):
+            for v in range(_params['versions']):
+                files.append(os.path.join(
+                    'repo{r}'.format(r=r),
+                    'chart{c}-{version}.tgz'.format(c=c, version=chart_version(v))
+                ))
+
+    return files
+
+def dataset_marker(_root):
+    #None when _root holds no dataset generated by charthall_bench,
+    #refuses to touch a non empty directory which is not a dataset
+    marker=os.path.join(_root, BENCH_MARKER)
+
+    if not os.path.isdir(_root) or len(os.listdir(_root)) == 0:
+        return None
+
+    try:
+        with open(marker, 'r') as f:
+            data=json.load(f)
+    except Exception:
+        raise Exception(
+            '{root} is not empty and has no readable {marker}, refusing to use it as BENCH_DIR'.format(
+                root=_root,
+                marker=BENCH_MARKER
+            )
+        )
+
+    if 'params' not in data:
+        #marker of older charthall_bench holds just params
+        data={ 'params': data, 'files': dataset_files(data) }
+
+    return data
+
+def dataset_remove(_root, _marker):
+    #only files listed in marker, directories only when left empty
+    for f in _marker['files']:
+        try:
+            os.remove(os.path.join(_root, f))
+        except FileNotFoundError:
+            pass
+
+    for d in sorted(set(os.path.dirname(f) for f in _marker['files'])):
+        if d == '':
+            continue
+        try:
+            os.rmdir(os.path.join(_root, d))
+        except OSError:
+            pass
+
+    dataset_clear_state(_root)
+    os.remove(os.path.join(_root, BENCH_MARKER))
+
+def dataset_generate(_root, _repos, _charts, _versions, _size, _seed):
+    params={
+        'repos': _repos,
+        'charts': _charts,
+        'versions': _versions,
+        'size': _size,
+        'seed': _seed
+    }
+
+    marker=dataset_marker(_root)
+
+    #generated dataset is reused when parameters did not change
+    if marker is not None and marker['params'] == params:
+        log_print('INFO', 'dataset_generate({root}): reusing'.format(root=_root))
+        return params
+
+    log_print(
+        'INFO', 'dataset_generate({root}): {repos} repos x {charts} charts x {versions} versions, {size} bytes'.format(
+            root=_root,
+            repos=_repos,
+            charts=_charts,
+            versions=_versions,
+            size=_size
+        )
+    )
+
+    if marker is not None:
+        dataset_remove(_root, marker)
+
+    os.makedirs(_root, exist_ok=True)
+
+    files=dataset_files(params)
+
+    #written before the first chart, so an interrupted generation is
+    #still recognised and cleaned up by the next run
+    with open(os.path.join(_root, BENCH_MARKER), 'w') as f:
+        json.dump({ 'params': None, 'files': files }, f)
+
+    rnd=random.Random(_seed)
+    pool=rnd.randbytes(max(_size*4, 64*1024))
+
+    for r in range(_repos):
+        repo_dir=os.path.join(_root, 'repo{r}'.format(r=r))
+        os.makedirs(repo_dir, exist_ok=True)
+
+        for c in range(_charts):
+            chart='chart{c}'.format(c=c)
+
+            for v in range(_versions):
+                version=chart_version(v)
+
+                with open(os.path.join(repo_dir, chart+'-'+version+'.tgz'), 'wb') as f:
+                    f.write(chart_tgz(chart, version, _size, pool, rnd))
+
+    with open(os.path.join(_root, BENCH_MARKER), 'w') as f:
+        json.dump({ 'params': params, 'files': files }, f)
+
+    return params
+
+def dataset_clear_state(_root):
+    #ledger and snapshot would turn a cold start into a warm one, state
+    #is removed only from a directory generated by charthall_bench
+    if not os.path.exists(os.path.join(_root, BENCH_MARKER)):
+        raise Exception('{root} has no {marker}, refusing to remove its state'.format(
+            root=_root,
+            marker=BENCH_MARKER
+        ))
+
+    shutil.rmtree(os.path.join(_root, charthall_py.CHARTHALL_STATE_DIR), ignore_errors=True)
+
+################ DRIVERS ################
+def summary(_latencies, _elapsed, _bytes):
+    latencies=sorted(_latencies)
+    n=len(latencies)
+
+    if n == 0:
+        return { 'requests': 0 }
+
+    def percentile(_p):
+        return latencies[ min(n-1, int(n*_p)) ]
+
+    return {
+        'requests': n,
+        'seconds': _elapsed,
+        'requests_per_second': n/_elapsed,
+        'bytes_per_second': _bytes/_elapsed,
+        'latency_mean': sum(latencies)/n,
+        'latency_p50': percentile(0.5),
+        'latency_p90': percentile(0.9),
+        'latency_p99': percentile(0.99),
+        'latency_max': latencies[-1]
+    }
+
+def bench_rebuild_in_process(_root, _index_limit):
+    #cache_rebuild() of a cold storage and then with the digest ledger in place
+    dataset_clear_state(_root)
+
+    #charthall logs to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        return bench_rebuild(_root, _index_limit)
+
+def bench_rebuild(_root, _index_limit):
+
+    charthall_py.configure(
+        _storage_local_rootdir=_root,
+        _index_limit=str(_index_limit),
+        _snapshot='false'
+    )
+    charthall_py.digest_engine_start(
+        charthall_py.CHARTHALL_INDEX_LIMIT,
+        charthall_py.CHARTHALL_DIGEST_MEMORY_LIMIT
+    )
+
+    results={}
+
+    for phase in [ 'cold', 'warm' ]:
+        start=time.perf_counter()
+        charthall_py.cache_rebuild()
+        results[phase+'_seconds']=time.perf_counter()-start
+
+    results['charts']=sum(
+        len(charthall_py.CACHE['ledger'].get(r, {})) for r in charthall_py.CACHE['index']
+    )
+
+    return results
+
+class Server:
+    #charthall.py started on localhost, the way it runs in the image
+
+    def __init__(self, _root, _env=None):
+        self.root=_root
+        self.port=free_port()
+        self.env=dict(os.environ)
+        self.env.update({
+            'STORAGE_LOCAL_ROOTDIR': _root,
+            'PORT': str(self.port),
+            'INDEX_LIMIT': str(BENCH_INDEX_LIMIT)
+        })
+        if _env is not None:
+            self.env.update(_env)
+
+        self.process=None
+
+    def start(self):
+        script=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'charthall.py')
+
+        start=time.perf_counter()
+
+        self.process=subprocess.Popen(
+            [ sys.executable, script ],
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        while time.perf_counter()-start < BENCH_STARTUP_TIMEOUT:
+            if self.process.poll() is not None:
+                raise Exception('charthall exited with {code}'.format(code=self.process.returncode))
+
+            try:
+                status, body, headers=self.request('GET', '/health')
+                if status == 200:
+                    return time.perf_counter()-start
+            except Exception:
+                pass
+
+            time.sleep(0.05)
+
+        raise Exception('charthall did not start in {timeout}s'.format(timeout=BENCH_STARTUP_TIMEOUT))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process=None
+
+    def connection(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+
+    def request(self, _method, _path, _body=None, _headers=None, _connection=None):
+        connection=_connection or self.connection()
+
+        try:
+            connection.request(_method, _path, body=_body, headers=_headers or {})
+            response=connection.getresponse()
+            body=response.read()
+            return (response.status, body, response.headers)
+        finally:
+            if _connection is None:
+                connection.close()
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def run_concurrent(_server, _concurrency, _paths, _headers=None):
+    #_paths are shared by _concurrency clients, each on its own keep-alive connection
+    latencies=[]
+    transferred=[ 0 ]
+    errors=[ 0 ]
+    lock=threading.Lock()
+    position=[ 0 ]
+
+    def client():
+        connection=_server.connection()
+        local=[]
+        local_bytes=0
+        local_errors=0
+
+        try:
+            while True:
+                with lock:
+                    i=position[0]
+                    position[0]=i+1
+
+                if i >= len(_paths):
+                    break
+
+                start=time.perf_counter()
+                try:
+                    status, body, headers=_server.request('GET', _paths[i], None, _headers, connection)
+                    if status != 200:
+                        local_errors+=1
+                    local_bytes+=len(body)
+                except Exception:
+                    local_errors+=1
+                    connection.close()
+                    connection=_server.connection()
+
+                local.append(time.perf_counter()-start)
+        finally:
+            connection.close()
+
+        with lock:
+            latencies.extend(local)
+            transferred[0]+=local_bytes
+            errors[0]+=local_errors
+
+    threads=[ threading.Thread(target=client) for i in range(_concurrency) ]
+
+    start=time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed=time.perf_counter()-start
+
+    result=summary(latencies, elapsed, transferred[0])
+    result['errors']=errors[0]
+    result['concurrency']=_concurrency
+
+    return result
+
+def bench_index(_server, _repo, _requests, _concurrency, _encoding):
+    headers={ 'Accept-Encoding': _encoding }
+
+    #first request renders whatever is pending
+    _server.request('GET', '/'+_repo+'/index.yaml', None, headers)
+
+    results={}
+    for c in _concurrency:
+        results[str(c)]=run_concurrent(
+            _server,
+            c,
+            [ '/'+_repo+'/index.yaml' ]*_requests,
+            headers
+        )
+
+    return results
+
+def bench_download(_server, _root, _repo, _requests, _concurrency):
+    files=sorted(f for f in os.listdir(os.path.join(_root, _repo)) if f.endswith('.tgz'))
+
+    if len(files) == 0:
+        return {}
+
+    paths=[ '/'+_repo+'/charts/'+files[i%len(files)] for i in range(_requests) ]
+
+    results={}
+    for c in _concurrency:
+        results[str(c)]=run_concurrent(_server, c, paths)
+
+    return results
+
+def bench_post(_server, _repo, _posts, _size, _seed):
+    #charts are generated up front, only upload and indexing are measured
+    rnd=random.Random(_seed+1)
+    pool=rnd.randbytes(max(_size*4, 64*1024))
+
+    boundary='charthall-bench-boundary'
+    bodies=[]
+
+    for i in range(_posts):
+        chart='benchpost'
+        version=chart_version(i)
+        data=chart_tgz(chart, version, _size, pool, rnd)
+
+        bodies.append(
+            '--{b}\r\nContent-Disposition: form-data; name="chart"; filename="{f}"\r\nContent-Type: application/gzip\r\n\r\n'.format(
+                b=boundary,
+                f=chart+'-'+version+'.tgz'
+            ).encode('utf-8')+data+'\r\n--{b}--\r\n'.format(b=boundary).encode('utf-8')
+        )
+
+    headers={ 'Content-Type': 'multipart/form-data; boundary='+boundary }
+
+    connection=_server.connection()
+    latencies=[]
+    errors=0
+
+    start=time.perf_counter()
+    for body in bodies:
+        t=time.perf_counter()
+        status, response, response_headers=_server.request('POST', '/api/'+_repo+'/charts', body, headers, connection)
+        if status != 201:
+            errors+=1
+        latencies.append(time.perf_counter()-t)
+    elapsed=time.perf_counter()-start
+
+    connection.close()
+
+    result=summary(latencies, elapsed, sum(len(b) for b in bodies))
+    result['errors']=errors
+
+    #remove uploaded charts, dataset stays reusable
+    for i in range(_posts):
+        _server.request('DELETE', '/api/'+_repo+'/charts/benchpost/'+chart_version(i))
+
+    return result
+
+################ MAIN ################
+def configure():
+    global BENCH_REPOS
+    global BENCH_CHARTS
+    global BENCH_VERSIONS
+    global BENCH_SIZE
+    global BENCH_POSTS
+    global BENCH_REQUESTS
+    global BENCH_DOWNLOADS
+    global BENCH_CONCURRENCY
+    global BENCH_INDEX_LIMIT
+    global BENCH_ENCODING
+    global BENCH_DIR
+    global BENCH_OUTPUT
+    global BENCH_SEED
+
+    for name, parse in [
+        ('BENCH_REPOS', int),
+        ('BENCH_CHARTS', int),
+        ('BENCH_VERSIONS', int),
+        ('BENCH_SIZE', charthall_py.parse_size),
+        ('BENCH_POSTS', int),
+        ('BENCH_REQUESTS', int),
+        ('BENCH_DOWNLOADS', int),
+        ('BENCH_CONCURRENCY', lambda _v: [ int(c) for c in _v.split(',') if c.strip() != '' ]),
+        ('BENCH_INDEX_LIMIT', int),
+        ('BENCH_ENCODING', str),
+        ('BENCH_DIR', str),
+        ('BENCH_OUTPUT', str),
+        ('BENCH_SEED', int)
+    ]:
+        value=os.getenv(name)
+        if value is None or value == '':
+            continue
+
+        try:
+            globals()[name]=parse(value)
+        except Exception:
+            log_print('WARNING', '{name}={value} ignored'.format(name=name, value=value))
+
+def main():
+    configure()
+
+    root=BENCH_DIR
+    remove_root=False
+    if root is None:
+        root=tempfile.mkdtemp(prefix='charthall-bench-')
+        remove_root=True
+
+    try:
+        results={
+            'charthall_version': charthall_py.CHARTHALL_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'started': datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            'params': {
+                'dataset': dataset_generate(root, BENCH_REPOS, BENCH_CHARTS, BENCH_VERSIONS, BENCH_SIZE, BENCH_SEED),
+                'posts': BENCH_POSTS,
+                'requests': BENCH_REQUESTS,
+                'downloads': BENCH_DOWNLOADS,
+                'concurrency': BENCH_CONCURRENCY,
+                'index_limit': BENCH_INDEX_LIMIT,
+                'encoding': BENCH_ENCODING
+            },
+            'results': {}
+        }
+
+        log_print('INFO', 'rebuild in process')
+        results['results']['rebuild']=bench_rebuild_in_process(root, BENCH_INDEX_LIMIT)
+
+        #cold start of the server, without ledger and snapshot
+        dataset_clear_state(root)
+
+        server=Server(root)
+        try:
+            log_print('INFO', 'startup')
+            results['results']['startup_seconds']=server.start()
+
+            log_print('INFO', 'index.yaml')
+            results['results']['index_yaml']=bench_index(server, 'repo0', BENCH_REQUESTS, BENCH_CONCURRENCY, BENCH_ENCODING)
+
+            log_print('INFO', 'chart download')
+            results['results']['download']=bench_download(server, root, 'repo0', BENCH_DOWNLOADS, BENCH_CONCURRENCY)
+
+            log_print('INFO', 'POST /api/{repo}/charts')
+            results['results']['post']=bench_post(server, 'repo0', BENCH_POSTS, BENCH_SIZE, BENCH_SEED)
+
+            log_print('INFO', 'index.yaml after POST')
+            results['results']['index_yaml_after_post']=bench_index(server, 'repo0', BENCH_REQUESTS, [ 1 ], BENCH_ENCODING)
+        finally:
+            server.stop()
+
+        output=json.dumps(results, indent=2, sort_keys=True)
+
+        if BENCH_OUTPUT is None:
+            print(output)
+        else:
+            with open(BENCH_OUTPUT, 'w') as f:
+                f.write(output+'\n')
+
+    finally:
+        if remove_root:
+            shutil.rmtree(root, ignore_errors=True)
@@ -15,25 +15,48 @@
 # limitations under the License.
 
 import os
-from pickle import APPEND
 import sys
-import io
 import datetime
 import distutils
 import threading
 import time
-import math
-import multiprocessing
-import multiprocessing.pool
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
 import hashlib
+import json
+import marshal
+import mmap
+import select
+import socket
+import struct
+import tarfile
+import zlib
 from threading import Lock
 
-from flask import Flask, after_this_request, request, send_file
+from flask import Flask, Response, after_this_request, g, request, send_file
 from flask_log_request_id import RequestID, current_request_id
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.datastructures import Headers
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
+import base64
+import bisect
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli=None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
 
 CHARTHALL_VERSION="0.0.5"
 
@@ -52,7 +75,82 @@ CHARTHALL_CACHE_INTERVAL=0
 CHARTHALL_ALLOW_OVERWRITE=True
 
 CHARTHALL_INDEX_LIMIT=50
-CHARTHALL_INDEX_RATIO=1024
+CHARTHALL_DIGEST_MEMORY_LIMIT=64*1024*1024
+CHARTHALL_DIGEST_CHUNK_MIN=64*1024
+CHARTHALL_DIGEST_CHUNK_MAX=1024*1024
+
+#internal state kept under STORAGE_LOCAL_ROOTDIR, never listed as a repo
+CHARTHALL_STATE_DIR='.charthall'
+
+#preferred first when client accepts several with the same quality
+CHARTHALL_ENCODINGS=[]
+if brotli is not None:
+    CHARTHALL_ENCODINGS.append('br')
+if zstandard is not None:
+    CHARTHALL_ENCODINGS.append('zstd')
+CHARTHALL_ENCODINGS.append('gzip')
+CHARTHALL_ENCODINGS.append('identity')
+
+#streams of these can't be joined from blocks, whole document is
+#compressed on the first request after a change
+CHARTHALL_ENCODINGS_WHOLE=[ 'br', 'zstd' ]
+
+#gzip member header without name and mtime, level 6, unknown OS
+CHARTHALL_GZIP_HEADER=b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+CHARTHALL_RENDER_BLOCK=64
+CHARTHALL_JOURNAL_SIZE=10000
+CHARTHALL_RENDER_DELAY=1
+CHARTHALL_INDEX_STREAMING=False
+
+#set when serving with multiple processes, see charthall.py
+CHARTHALL_SHARED_DIR=None
+CHARTHALL_SHARED_MAGIC=b'CHARTHALL-SHARED-1\n'
+CHARTHALL_SHARED_CHUNK=256*1024
+CHARTHALL_WRITER_SOCKET=None
+
+CHARTHALL_PAGE_LIMIT=1000
+
+#rendered yaml and json fragments of chart versions kept in memory
+CHARTHALL_FRAGMENT_CACHE=20000
+
+#always - file and directory are synced before upload returns
+#file - file is synced before rename, rename may be lost on crash
+#never - left to the operating system
+CHARTHALL_FSYNC='file'
+
+CHARTHALL_LAZY_LOAD=False
+CHARTHALL_LOAD_TIMEOUT=30
+
+CHARTHALL_SERVER_TIMING=False
+CHARTHALL_PROFILER=False
+CHARTHALL_PROFILER_MAX_SECONDS=60
+
+CHARTHALL_WATCH=False
+CHARTHALL_WATCH_DELAY=2
+CHARTHALL_WATCH_POLL=10
+
+#set when running as a read replica of another charthall
+CHARTHALL_FOLLOW_LEADER=None
+CHARTHALL_FOLLOW_USER=None
+CHARTHALL_FOLLOW_PASS=None
+CHARTHALL_FOLLOW_INTERVAL=10
+CHARTHALL_FOLLOW_TIMEOUT=60
+
+INOTIFY={
+    'IN_CLOSE_WRITE': 0x00000008,
+    'IN_MOVED_FROM': 0x00000040,
+    'IN_MOVED_TO': 0x00000080,
+    'IN_CREATE': 0x00000100,
+    'IN_DELETE': 0x00000200,
+    'IN_Q_OVERFLOW': 0x00004000,
+    'IN_IGNORED': 0x00008000,
+    'IN_ISDIR': 0x40000000
+}
+
+CHARTHALL_SNAPSHOT=True
+CHARTHALL_SNAPSHOT_DELAY=5
+CHARTHALL_SNAPSHOT_MAGIC=b'CHARTHALL-SNAPSHOT-7\n'
 
 CACHE={
     'info': '{{"version":"v{version}"}}'.format(
@@ -62,30 +160,107 @@ CACHE={
     'repos': """---
 repos: []
 """,
-    'mutexes' : {}
+    'mutexes' : {},
+    'ledger': {},
+    'ledger_dirty': set(),
+    'snapshot_dirty': set(),
+    'snapshot_event': threading.Event(),
+    'render_dirty': set(),
+    'rendering': set(),
+    'render_event': threading.Event(),
+    'shared': {},
+    # { repo: set of chart files changed while the repo is being rebuilt }
+    'rebuilding': {},
+    # { repo: event set when repo is indexed for the first time }
+    'pending': {},
+    # { repo: { files, to_hash, hashed } } of the last rebuild
+    'progress': {},
+    # { repo: lock held while the whole document is compressed with brotli or zstd }
+    'encoding': {}
 }
     
 RE_VERSION=re.compile('([0-9]+\.){2,}[0-9]+')
 
 MUTEX = Lock()
 
-class NoDaemonProcess(multiprocessing.Process):
-    # make 'daemon' attribute always return False
-    @property
-    def daemon(self):
-        return False
+#encoded headers and separators of rendered documents
+RENDER_CONSTANTS={}
 
-    @daemon.setter
-    def daemon(self, val):
-        pass
+#threads rebuilding repos live as long as application, so their metrics
+#shards are not piling up with every rebuild
+REBUILD={
+    'pool': None,
+    'workers': 0
+}
+
+DIGEST={
+    'engine': None,
+    'chunk': CHARTHALL_DIGEST_CHUNK_MAX,
+    'buffers': threading.local(),
+    #work of every repo waits in its own queue, workers take from
+    #queues round robin so a big repo does not starve the small ones
+    'queues': collections.OrderedDict(),
+    'condition': threading.Condition(),
+    #repos somebody waits for, served before the others
+    'priority': set()
+}
+
+#repos waiting for the first indexing when LAZY_LOAD=true
+LOADER={
+    'queue': [],
+    'condition': threading.Condition()
+}
+
+#every thread updates only its own shard, shards are summed on scrape
+METRICS={
+    'shards': [],
+    'local': threading.local(),
+    'lock': Lock()
+}
+
+#phases of the request handled by the thread, reported in Server-Timing
+TIMING=threading.local()
 
-class NoDaemonProcessPool(multiprocessing.pool.Pool):
+PROFILER={
+    'lock': Lock()
+}
+
+#rendered fragments of records, least recently used are dropped
+FRAGMENTS={
+    # { ( kind, repo, record ): fragment }
+    'cache': collections.OrderedDict(),
+    'lock': Lock()
+}
 
-    def Process(self, *args, **kwds):
-        proc = super(NoDaemonProcessPool, self).Process(*args, **kwds)
-        proc.__class__ = NoDaemonProcess
+#inverted index of chart names of all repos
+SEARCH={
+    # { token or trigram: set of ( repo, chart ) }
+    'postings': {},
+    # set of ( repo, chart ), grams are derived from the name again when
+    #the entry is removed, storing them would take twice the postings
+    'entries': set(),
+    'lock': Lock()
+}
 
-        return proc
+METRICS_BUCKETS_SECONDS=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_BUCKETS_BYTES=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+
+METRICS_HELP={
+    'charthall_http_request_duration_seconds': ('histogram', 'time until response headers are ready'),
+    'charthall_http_response_size_bytes': ('histogram', 'Content-Length of responses'),
+    'charthall_rebuild_duration_seconds': ('histogram', 'duration of rebuild of a repo'),
+    'charthall_rebuild_files_hashed_total': ('counter', 'files hashed by rebuild'),
+    'charthall_digest_bytes_total': ('counter', 'bytes hashed by calculate_digest'),
+    'charthall_digest_seconds_total': ('counter', 'seconds spent in calculate_digest'),
+    'charthall_digest_throughput_bytes_per_second': ('gauge', 'digest_bytes_total divided by digest_seconds_total'),
+    'charthall_repo_mutex_wait_seconds': ('histogram', 'time waited for repo mutex'),
+    'charthall_repo_mutex_hold_seconds': ('histogram', 'time repo mutex was held'),
+    'charthall_uploads_total': ('counter', 'uploaded charts'),
+    'charthall_upload_bytes_total': ('counter', 'bytes of uploaded charts'),
+    'charthall_index_document_bytes': ('gauge', 'size of rendered index documents'),
+    'charthall_index_charts': ('gauge', 'charts in repo'),
+    'charthall_index_generation': ('gauge', 'generation of rendered index')
+}
 
 def log_print(_type, _msg):
     print(
@@ -97,6 +272,102 @@ def log_print(_type, _msg):
         )
     )
 
+def metrics_shard():
+    shard=getattr(METRICS['local'], 'shard', None)
+
+    if shard is None:
+        shard={ 'counters': {}, 'histograms': {} }
+        METRICS['local'].shard=shard
+
+        #only once per thread
+        METRICS['lock'].acquire()
+        try:
+            METRICS['shards'].append(shard)
+        finally:
+            METRICS['lock'].release()
+
+    return shard
+
+def metrics_inc(_name, _labels, _value=1):
+    # _labels is a tuple of (label, value) pairs
+    counters=metrics_shard()['counters']
+    key=(_name, _labels)
+
+    counters[key]=counters.get(key, 0)+_value
+
+def metrics_observe(_name, _labels, _value, _buckets=METRICS_BUCKETS_SECONDS):
+    histograms=metrics_shard()['histograms']
+    key=(_name, _labels)
+
+    h=histograms.get(key)
+    if h is None:
+        # [ buckets, counts per bucket with +Inf last, sum ]
+        h=[ _buckets, [0]*(len(_buckets)+1), 0 ]
+        histograms[key]=h
+
+    h[1][ bisect.bisect_left(_buckets, _value) ]+=1
+    h[2]+=_value
+
+def metrics_labels(_labels):
+    if len(_labels) == 0:
+        return ''
+
+    return '{'+','.join(
+        '{k}="{v}"'.format(
+            k=k,
+            v=str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        ) for k, v in _labels
+    )+'}'
+
+def timing_add(_phase, _seconds):
+    #no-op outside of requests and when SERVER_TIMING is off
+    phases=getattr(TIMING, 'phases', None)
+
+    if phases is not None:
+        phases[_phase]=phases.get(_phase, 0)+_seconds
+
+def timing_header(_phases, _total):
+    return ', '.join(
+        [ '{phase};dur={ms:.3f}'.format(phase=p, ms=_phases[p]*1000) for p in _phases ]
+        +[ 'app;dur={ms:.3f}'.format(ms=_total*1000) ]
+    )
+
+class MeteredLock:
+    #repo mutex measuring wait and hold times, a lock is released
+    #by the thread which acquired it, so a single start time is enough
+
+    def __init__(self, _repo):
+        self.lock=Lock()
+        self.labels=(('repo', _repo),)
+        self.acquired=0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start=time.perf_counter()
+
+        result=self.lock.acquire(blocking, timeout)
+
+        if result:
+            self.acquired=time.perf_counter()
+            metrics_observe('charthall_repo_mutex_wait_seconds', self.labels, self.acquired-start)
+            timing_add('mutex', self.acquired-start)
+
+        return result
+
+    def release(self):
+        metrics_observe('charthall_repo_mutex_hold_seconds', self.labels, time.perf_counter()-self.acquired)
+
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.release()
+
 def extract_name_version(_filename):
     parts=_filename.split('-')
 
@@ -118,720 +389,3729 @@ def extract_name_version(_filename):
         'version': '-'.join(chart_version)
     }
 
-def calculate_digest(_data):   
+RE_CONSTRAINT_VERSION=re.compile('^v?([0-9]+|[xX*])(\\.([0-9]+|[xX*]))?(\\.([0-9]+|[xX*]))?(-([0-9A-Za-z.-]+))?(\\+[0-9A-Za-z.-]+)?$')
+RE_CONSTRAINT_OPERATOR=re.compile('(>=|<=|!=|>|<|=|~|\\^)\\s+')
 
-    try:
-        fp=_data['file_path']
-        m = hashlib.sha256()
+def version_prerelease_key(_prerelease):
+    #numeric identifiers go before alphanumeric ones
+    key=[]
+    for i in _prerelease.split('.'):
+        if i.isdigit():
+            key.append((0, int(i), ''))
+        else:
+            key.append((1, 0, i))
 
-        with open(fp,"rb") as f:
-            m.update(f.read())
+    return tuple(key)
 
-        _data['digest']=m.hexdigest()
+def version_key(_version):
+    #semver precedence: numbers of the core, prerelease before its release,
+    #build metadata is ignored
+    version=_version.split('+', 1)[0]
+    core, sep, prerelease=version.partition('-')
 
-        return _data
-    except Exception as e:
-        return None
+    numbers=[]
+    for n in core.split('.'):
+        try:
+            numbers.append(int(n))
+        except ValueError:
+            numbers.append(-1)
 
-def calculate_digest_pool(_data_list):
+    if sep == '':
+        return (tuple(numbers), 1, ())
 
-    global CHARTHALL_INDEX_LIMIT
+    return (tuple(numbers), 0, version_prerelease_key(prerelease))
 
-    len_data_list=len(_data_list)
+def version_index_add(_cache, _chart, _version):
+    # { chart: [ sorted keys, versions in the same order ] }
+    if _chart not in _cache['versions']:
+        _cache['versions'][_chart]=[ [], [] ]
 
-    if len_data_list == 0:
-        return []
+    keys, versions=_cache['versions'][_chart]
+    key=version_key(_version)
 
-    pool_size = math.floor(len_data_list/CHARTHALL_INDEX_RATIO) + 1
+    i=bisect.bisect_right(keys, key)
+    keys.insert(i, key)
+    versions.insert(i, _version)
 
-    if pool_size > CHARTHALL_INDEX_LIMIT:
-        pool_size = CHARTHALL_INDEX_LIMIT
+def version_index_remove(_cache, _chart, _version):
+    if _chart not in _cache['versions']:
+        return
 
-    if len_data_list < CHARTHALL_INDEX_LIMIT:
-        pool_size=len_data_list
+    keys, versions=_cache['versions'][_chart]
+    i=bisect.bisect_left(keys, version_key(_version))
 
-    with multiprocessing.Pool(processes=pool_size) as pool:
-        data=pool.map(calculate_digest, _data_list)
+    while i < len(keys) and versions[i] != _version:
+        i=i+1
 
-    return data
-    
-def cache_rebuild():
-    repos=os.listdir(CHARTHALL_STORAGE_LOCAL_ROOTDIR)
-    
-    log_print('INFO', 'Rebuilding Cache start')
-    for r in repos:
-        if os.path.isdir(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, r)):
-            cache_add_repo(r)
-            CACHE['mutexes'][r].acquire()
-            cache_rebuild_repo_charts(r)
-            CACHE['mutexes'][r].release()
-    log_print('INFO', 'Rebuilding Cache finish')
-    
-def cache_add_repo(_repo):
+    if i < len(keys):
+        del keys[i]
+        del versions[i]
 
-    if _repo in CACHE['mutexes']:
-        return
+    if len(keys) == 0:
+        del _cache['versions'][_chart]
 
-    MUTEX.acquire()
-    repo_dir=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR,_repo)
+def version_constraint_bound(_version):
+    #( lowest key, key above all versions, numbers, full version ) matched
+    #by version, 1.4 and 1.4.x match 1.4.0 up to 1.5.0 excluded
+    m=RE_CONSTRAINT_VERSION.match(_version)
+    if m is None:
+        raise ValueError('invalid version in constraint: '+_version)
 
-    if not os.path.exists(repo_dir):
-        os.mkdir(repo_dir)
-    
-    CACHE['index'][_repo] = {
-        'yaml_chart_version':{},
-        'yaml_chart':{},        
-        'yaml':'---',
-        'json_chart_version':{},
-        'json_chart': {},
-        'json':'{}'
-    }
+    numbers=[]
+    for g in [ m.group(1), m.group(3), m.group(5) ]:
+        if g is None or not g.isdigit():
+            break
+        numbers.append(int(g))
 
-    CACHE['mutexes'][_repo] = Lock()     
-    str_repos="""---
-repos:
-"""
-    for p in CACHE['mutexes']:
-        str_repos=str_repos+"""- {repo}
-""".format(repo=p)
+    if m.group(7) is not None and len(numbers) == 3:
+        key=(tuple(numbers), 0, version_prerelease_key(m.group(7)))
+        return (key, key, numbers, True)
 
-    CACHE['repos']=str_repos
+    if len(numbers) == 3:
+        key=(tuple(numbers), 1, ())
+        return (key, key, numbers, True)
 
-    MUTEX.release()
+    if len(numbers) == 0:
+        return (None, None, numbers, False)
 
-def cache_render_chart_version(_cache, _repo, _data):
-    global CHARTHALL_CHART_URL
+    low=numbers+[0]*(3-len(numbers))
+    high=numbers[:-1]+[numbers[-1]+1]
+    high=high+[0]*(3-len(high))
 
-    c=_data['chart']
-    v=_data['version']
-    fp=_data['file_path']
+    return ((tuple(low), 0, ()), (tuple(high), 0, ()), numbers, False)
 
-    if c not in _cache['yaml_chart_version']:
-        _cache['yaml_chart_version'][c] = {}
-        _cache['json_chart_version'][c] = {}
+def version_constraint(_constraint):
+    #helm style constraint into alternatives of comparators:
+    #[ ( [ ( op, key ) ], prerelease allowed ) ], ops are >= > <= < = !=
+    #for keys, || separates alternatives, comma or space comparators
+    alternatives=[]
 
-    os_lstat_st_mtime=os.lstat(fp).st_mtime
+    for alternative in _constraint.split('||'):
+        comparators=[]
+        prerelease=False
 
-    _data['created_yaml']=datetime.datetime.fromtimestamp(
-        os_lstat_st_mtime,
-        tz=datetime.timezone.utc
-    ).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        alternative=RE_CONSTRAINT_OPERATOR.sub(r'\1', alternative.strip())
 
-    _data['created_json']=datetime.datetime.fromtimestamp(
-        os_lstat_st_mtime,
-        tz=datetime.timezone.utc
-    ).strftime("%Y-%m-%dT%H:%M:%S.%f000+00:00")
-    
-    _cache['yaml_chart_version'][ c ][ v ]="""    - apiVersion: v1
-      appVersion: {version}
-      created: "{created}"
-      description: {chart} {version}
-      digest: {digest}
-      name: {chart}
-      urls:
-        - {chart_url}/{repo}/charts/{filename}
-      version: {version}""".format(
-        chart=_data['chart'],
-        version=_data['version'],
-        filename=_data['filename'],
-        created=_data['created_json'],
-        chart_url=CHARTHALL_CHART_URL,
-        digest=_data['digest'],
-        repo=_repo
-    )
+        hyphen=alternative.split(' - ')
+        if len(hyphen) == 2:
+            tokens=[ '>='+hyphen[0].strip(), '<='+hyphen[1].strip() ]
+        else:
+            tokens=re.split('[\\s,]+', alternative)
+
+        for t in tokens:
+            if t == '':
+                continue
+
+            op=''
+            for o in [ '>=', '<=', '!=', '>', '<', '=', '~', '^' ]:
+                if t.startswith(o):
+                    op=o
+                    t=t[len(o):]
+                    break
+
+            low, high, numbers, exact=version_constraint_bound(t)
+            prerelease=prerelease or (exact and low[1] == 0)
+
+            if low is None:
+                #*, x
+                if op in [ '<', '!=' ]:
+                    comparators.append(('<', ((), 0, ())))
+                continue
+
+            if op == '~':
+                #~1.4.2 and ~1.4 up to 1.5.0, ~1 up to 2.0.0
+                upper=numbers[:2] if len(numbers) > 1 else numbers[:1]
+                upper=upper[:-1]+[upper[-1]+1]
+                comparators.append(('>=', low))
+                comparators.append(('<', (tuple(upper+[0]*(3-len(upper))), 0, ())))
+            elif op == '^':
+                #first non zero number of the core may not change
+                i=0
+                while i < len(numbers)-1 and numbers[i] == 0:
+                    i=i+1
+                upper=numbers[:i]+[numbers[i]+1]
+                comparators.append(('>=', low))
+                comparators.append(('<', (tuple(upper+[0]*(3-len(upper))), 0, ())))
+            elif op == '>=':
+                comparators.append(('>=', low))
+            elif op == '>':
+                comparators.append(('>' if exact else '>=', high))
+            elif op == '<':
+                comparators.append(('<', low))
+            elif op == '<=':
+                comparators.append(('<=' if exact else '<', high))
+            elif op == '!=':
+                if exact:
+                    comparators.append(('!=', low))
+                else:
+                    raise ValueError('!= needs full version: '+t)
+            elif exact:
+                comparators.append(('=', low))
+            else:
+                comparators.append(('>=', low))
+                comparators.append(('<', high))
+
+        alternatives.append((comparators, prerelease))
+
+    return alternatives
+
+def version_select(_cache, _chart, _constraint=None, _top=1, _prerelease=False):
+    #versions of chart matching constraint, newest first, bisect finds
+    #the range of every alternative, prereleases are skipped unless asked
+    #for or named by the constraint
+    if _chart not in _cache['versions']:
+        return []
 
-    _cache['json_chart_version'][ c ][ v ]='{{"name":"{chart}","version":"{version}","description":"{chart} {version}","apiVersion":"v1","appVersion":"{version}","urls":["{chart_url}/{repo}/charts/{filename}"],"created":"{created}","digest":"{digest}"}}'.format(
-        chart=_data['chart'],
-        version=_data['version'],
-        filename=_data['filename'],
-        created=_data['created_json'],
-        chart_url=CHARTHALL_CHART_URL,
-        digest=_data['digest'],
-        repo=_repo        
-    ) 
+    keys, versions=_cache['versions'][_chart]
 
-def cache_render_chart(_cache, _chart):
+    if _constraint is None or _constraint.strip() == '':
+        alternatives=[ ([], False) ]
+    else:
+        alternatives=version_constraint(_constraint)
+
+    found={}
+
+    for comparators, prerelease in alternatives:
+        lo=0
+        hi=len(keys)
+        excluded=set()
+
+        for op, key in comparators:
+            if op == '>=':
+                lo=max(lo, bisect.bisect_left(keys, key))
+            elif op == '>':
+                lo=max(lo, bisect.bisect_right(keys, key))
+            elif op == '<':
+                hi=min(hi, bisect.bisect_left(keys, key))
+            elif op == '<=':
+                hi=min(hi, bisect.bisect_right(keys, key))
+            elif op == '=':
+                lo=max(lo, bisect.bisect_left(keys, key))
+                hi=min(hi, bisect.bisect_right(keys, key))
+            elif op == '!=':
+                excluded.add(key)
+
+        count=0
+        i=hi-1
+        while i >= lo and count < _top:
+            if keys[i] not in excluded \
+                and (keys[i][1] == 1 or prerelease or _prerelease):
+                found[i]=versions[i]
+                count=count+1
+            i=i-1
+
+    return [ found[i] for i in sorted(found, reverse=True)[:_top] ]
+
+def search_grams(_chart):
+    #tokens of the name and its trigrams, name shorter than a trigram is
+    #kept whole, so every substring of a name is part of one of its grams
+    name=_chart.lower()
+    grams=set(t for t in re.split('[-_.]+', name) if t != '')
+
+    if len(name) < 3:
+        grams.add(name)
+
+    for i in range(len(name)-2):
+        grams.add(name[i:i+3])
+
+    return grams
+
+def search_add(_repo, _chart):
+    entry=(_repo, _chart)
+
+    SEARCH['lock'].acquire()
+    try:
+        if entry in SEARCH['entries']:
+            return
 
-    _cache['yaml_chart'][ _chart ]="""  {chart}:
-{list}""".format(
-        chart=_chart,
-        list="\n".join(
-            _cache['yaml_chart_version'][_chart].values()
-        )
-    )
+        SEARCH['entries'].add(entry)
 
-    _cache['json_chart'][ _chart ]='[{list}]'.format(
-        chart=_chart,
-        list=",".join(
-            _cache['json_chart_version'][_chart].values()
-        )
-    )
+        for g in search_grams(_chart):
+            if g not in SEARCH['postings']:
+                SEARCH['postings'][g]=set()
+            SEARCH['postings'][g].add(entry)
+    finally:
+        SEARCH['lock'].release()
 
-def cache_render(_cache):
-    now_generated=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
+def search_remove(_repo, _chart):
+    entry=(_repo, _chart)
 
-    if len( _cache['yaml_chart'].values())==0: 
+    SEARCH['lock'].acquire()
+    try:
+        if entry not in SEARCH['entries']:
+            return
 
-        _cache['yaml']="""apiVersion: v1
-entries: {{}}
-generated: "{generated}"
-serverInfo: {{}}
-""".format(
-            generated=now_generated
-        )
+        SEARCH['entries'].discard(entry)
 
-        _cache['json']="{}"
-        return
+        for g in search_grams(_chart):
+            postings=SEARCH['postings'][g]
+            postings.discard(entry)
+            if len(postings) == 0:
+                del SEARCH['postings'][g]
+    finally:
+        SEARCH['lock'].release()
 
-    _cache['yaml']="""apiVersion: v1
-entries:
-{list}
-generated: "{generated}"
-serverInfo: {{}}
-""" .format(
-        list="\n".join(
-            _cache['yaml_chart'].values()
-        ),
-        generated=now_generated
-    )
+def search_repo_swap(_repo, _previous, _cache):
+    #charts of the cache which replaces previous one of repo
+    previous=set()
+    if _previous is not None:
+        previous=set(_previous['charts'])
 
-    list=[]
-    for c in _cache['json_chart']:
-        list.append( '"'+c+'": '+_cache['json_chart'][c])
+    current=set(_cache['charts'])
 
-    _cache['json']='{{{list}}}' .format(
-        list=",".join(
-            list
-        )
-    )
+    for c in previous-current:
+        search_remove(_repo, c)
 
-def cache_rebuild_repo_charts(_repo):
+    for c in current-previous:
+        search_add(_repo, c)
 
-#    log_print('INFO:','cache_rebuild_repo_charts('+ _repo+') start')
+def search_find(_q):
+    #entries with name containing q, q shorter than a trigram is looked up
+    #in all grams containing it
+    q=_q.lower()
 
-    repo_path = os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo )
-    files=os.listdir(repo_path)
-    
-    cache= {
-        'yaml_chart_version':{},
-        'yaml_chart':{},        
-        'yaml':'---',
-        'json_chart_version':{},
-        'json_chart': {},
-        'json':'{}'
-    }
+    SEARCH['lock'].acquire()
+    try:
+        if len(q) < 3:
+            found=set()
+            for g, p in SEARCH['postings'].items():
+                if q in g:
+                    found.update(p)
+
+            return set(e for e in found if q in e[1].lower())
+
+        postings=[]
+        for i in range(len(q)-2):
+            p=SEARCH['postings'].get(q[i:i+3])
+            if p is None:
+                return set()
+            postings.append(p)
+
+        postings.sort(key=len)
+
+        found=set(postings[0])
+        for p in postings[1:]:
+            found.intersection_update(p)
+            if len(found) == 0:
+                break
+    finally:
+        SEARCH['lock'].release()
 
-    c_list=[]
+    #trigrams may come from different parts of the name
+    return set(e for e in found if q in e[1].lower())
 
-    for f in files:
-        if not f.endswith('.tgz'):
-            continue
+def repo_name_valid(_repo):
+    return _repo != '' and not _repo.startswith('.')
 
-        file_path = os.path.join(repo_path, f)
+def state_path(*_parts):
+    return os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, CHARTHALL_STATE_DIR, *_parts)
 
-        if not os.path.isfile(file_path):
-            continue
+def ledger_path(_repo):
+    return state_path('ledger', _repo+'.json')
 
-        data=extract_name_version(
-            f.replace('.tgz','')
+def ledger_load(_repo):
+    # { filename: [ inode, size, mtime_ns, digest ] }
+    try:
+        with open(ledger_path(_repo), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log_print(
+            'WARNING', 'ledger_load({repo}): {msg}'.format(
+                repo=_repo,
+                msg=str(e)
+            )
         )
+        return {}
 
-        if data is not None and data['version'] == '':
-            continue
+def ledger_save(_repo, _ledger):
+    file_path=ledger_path(_repo)
+    tmp_path=file_path+'.tmp'
 
-        data['file_path']=file_path
-        data['filename']=f
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-        c_list.append(data)
+        with open(tmp_path, 'w') as f:
+            json.dump(_ledger, f, separators=(',',':'))
 
-    c_list=CHARTHALL_DIGEST_POOL.map(calculate_digest_pool, [ c_list ])
-        
-    for d in c_list[0]:
-        if d is None:
-            continue
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        log_print(
+            'WARNING', 'ledger_save({repo}): {msg}'.format(
+                repo=_repo,
+                msg=str(e)
+            )
+        )
 
-        cache_render_chart_version(cache, _repo, d)
+def ledger_entry(_stat, _digest):
+    return [ _stat.st_ino, _stat.st_size, _stat.st_mtime_ns, _digest ]
 
-    for c in cache['yaml_chart_version']:
-        cache_render_chart(cache, c)
-    
-    cache_render(cache)
+def ledger_match(_entry, _stat):
+    return _entry is not None \
+        and _entry[0] == _stat.st_ino \
+        and _entry[1] == _stat.st_size \
+        and _entry[2] == _stat.st_mtime_ns
 
-    CACHE['index'][_repo]=cache
+def ledger_update(_repo, _data):
+    if _repo not in CACHE['ledger']:
+        CACHE['ledger'][_repo]=ledger_load(_repo)
 
-#    log_print('INFO:','cache_rebuild_repo_charts('+ _repo+') finish')
-                    
-def put_file(_repo, _extension, _req_file):
-    global CHARTHALL_ALLOW_OVERWRITE
-    
-    if _req_file is None:
-        return
+    try:
+        CACHE['ledger'][_repo][ _data['filename'] ]=ledger_entry(
+            os.stat(_data['file_path']),
+            _data['digest']
+        )
+    except Exception:
+        CACHE['ledger'][_repo].pop(_data['filename'], None)
 
-    basename=os.path.basename(_req_file.filename)
-    data=extract_name_version(basename.replace(_extension,''))
+    CACHE['ledger_dirty'].add(_repo)
 
-    repo_dir = os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR,_repo)
-    file_path=os.path.join(repo_dir,basename)
+def snapshot_path(_repo):
+    return state_path('snapshot', _repo+'.snap')
 
-    if CHARTHALL_ALLOW_OVERWRITE == False \
-        and _repo in CACHE['index'] \
-        and data['chart'] in CACHE['index'][_repo]['json_chart_version'] \
-        and data['version'] in CACHE['index'][_repo]['json_chart_version'][ data['chart'] ]:
-        raise Exception("chart overwriting not allowed "+file_path)
+def snapshot_copy(_cache):
+    #called with repo mutex held, copies only containers which are changed
+    #in place, records, rendered blocks and journal entries are shared, so
+    #the copy can be marshalled after the mutex is released
+    cache=dict(_cache)
 
-    if not basename.endswith(_extension):
-        raise Exception('incorrect extension('+_extension+') '+basename)
+    cache['records']={ c: dict(v) for c, v in _cache['records'].items() }
+    cache['blocks']={
+        bid: dict(b, charts=list(b['charts'])) for bid, b in _cache['blocks'].items()
+    }
+    cache['block_order']=list(_cache['block_order'])
+    cache['chart_block']=dict(_cache['chart_block'])
+    cache['blocks_dirty']=set(_cache['blocks_dirty'])
+    cache['versions']={
+        c: [ list(v[0]), list(v[1]) ] for c, v in _cache['versions'].items()
+    }
+    cache['charts']=list(_cache['charts'])
+    cache['journal_pending']=list(_cache['journal_pending'])
 
-    if data['version']=='':
-        raise Exception('non semantic versioning '+basename)
+    if _cache['journal'] is not None:
+        cache['journal']=list(_cache['journal'])
 
-    _req_file.save(file_path)
+    if 'document_encoded' in _cache:
+        cache['document_encoded']=dict(_cache['document_encoded'])
 
-    data['filename']=basename
-    data['file_path']=file_path
+    return cache
 
-    data=calculate_digest(data)
+def snapshot_dumps(_cache):
+    global CHARTHALL_CHART_URL
 
-    return data
+    return marshal.dumps({
+        'chart_url': CHARTHALL_CHART_URL,
+        'encodings': CHARTHALL_ENCODINGS,
+        'cache': _cache
+    })
+
+def snapshot_write(_repo, _payload):
+    file_path=snapshot_path(_repo)
+    tmp_path=file_path+'.tmp'
 
-################ REQUESTS ################
-def request_post_api_repo_charts(_repo, _req_chart, _req_prov):
-            
-    if _req_chart is None:
-        return ('{"saved":false}', 400)
-    
     try:
-        cache_add_repo(_repo)
-        
-        CACHE['mutexes'][_repo].acquire()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-        cache=CACHE['index'][_repo]
+        with open(tmp_path, 'wb') as f:
+            f.write(CHARTHALL_SNAPSHOT_MAGIC)
+            f.write(_payload)
 
-        data=put_file(_repo, '.tgz', _req_chart)
-        if _req_prov is not None:
-            put_file(_repo, '.tgz.prov', _req_prov)
-        
-        cache_render_chart_version(cache, _repo, data)
-        cache_render_chart(cache, data['chart'])
-        cache_render(cache)
-        
+        os.replace(tmp_path, file_path)
     except Exception as e:
         log_print(
-            'ERROR', 'request_post_api_repo_charts({repo}): {msg}'.format(
+            'WARNING', 'snapshot_write({repo}): {msg}'.format(
                 repo=_repo,
                 msg=str(e)
             )
         )
-        return('{"saved":false}', 400)
-    finally:
-        CACHE['mutexes'][_repo].release()
-            
-    return ('{"saved":true}', 201)
-
-def request_post_api_repo_prov(_repo, _req_prov):
 
-    if _req_prov is None:
-        return ('{"saved":false}', 400)
+def snapshot_load(_repo):
+    global CHARTHALL_CHART_URL
 
     try:
-        put_file(_repo, '.tgz.prov', _req_prov)
-    except Exception as e:
-        log_print(
-            'ERROR', 'request_post_api_repo_prov({repo}): {msg}'.format(
-                repo=_repo,
-                msg=str(e)
-            )
-        )
-        return('{"saved":false}', 400)
+        with open(snapshot_path(_repo), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(CHARTHALL_SNAPSHOT_MAGIC)] != CHARTHALL_SNAPSHOT_MAGIC:
+                    raise Exception('unknown snapshot format')
 
-    return ('{"saved":true}', 201)
+                with memoryview(mm) as mv:
+                    data=marshal.loads(mv[len(CHARTHALL_SNAPSHOT_MAGIC):])
 
-def request_get_repo_charts_file(_repo, _file):
-    try:
-        mimetype='text/plain; charset=utf-8'
+        if data['chart_url'] != CHARTHALL_CHART_URL:
+            raise Exception('CHART_URL changed')
 
-        if _file.endswith('.tgz'):
-            mimetype='application/x-tar'
+        #blocks are kept compressed, with whatever was available then
+        if data.get('encodings') != CHARTHALL_ENCODINGS:
+            raise Exception('available encodings changed')
 
-        file_path=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _file)        
-        
-        with open(file_path, "rb") as bites:
-            return send_file(
-                io.BytesIO(bites.read()),
-                as_attachment=True,
-                attachment_filename=_file,
-                mimetype=mimetype
-            )
+        return data['cache']
 
+    except FileNotFoundError:
+        return None
     except Exception as e:
         log_print(
-            'ERROR',
-            'request_get_repo_charts_file({repo}, {file}): {msg}'.format(
+            'WARNING', 'snapshot_load({repo}): {msg}'.format(
                 repo=_repo,
-                file=_file,
                 msg=str(e)
             )
         )
-        return '{"error": "not found"}',404,{ 'Content-Type':'application/json; charset=utf-8'}
+        return None
 
-def request_delete_api_repo_charts_chart_version(_repo, _chart, _version):
-    if _repo not in CACHE['index']:
-        log_print(
-            'WARNING', 
-            'request_delete_api_repo_charts_chart_version({repo}, {chart}, {version}): repo() does not exist'.format(
-                repo=_repo,
-                chart=_chart,
-                version=_version
-            )
-        )
-        return ('{"deleted":false}', 404 )
-    
-    CACHE['mutexes'][_repo].acquire()
+def snapshot_load_all():
+    #( repos loaded from snapshot, repos without usable snapshot )
+    loaded=[]
+    missing=[]
 
-    try: 
-        if _chart not in CACHE['index'][_repo]['json_chart_version']:        
-            raise Exception('chart not in repo')
-    
-        if _version not in CACHE['index'][_repo]['json_chart_version'][_chart]:
-            raise Exception('version not in chart in project')
+    for r in os.listdir(CHARTHALL_STORAGE_LOCAL_ROOTDIR):
+        if not repo_name_valid(r):
+            continue
 
-        try:            
-            os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _chart+'-'+_version+'.tgz'))
-            os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _chart+'-'+_version+'.tgz.prov'))
-        except Exception as e:
-            log_print(
-                'WARNING', 
-                'request_delete_api_repo_charts_chart_version({repo}, {chart}, {version}): {msg}'.format(
-                    repo=_repo,
-                    chart=_chart,
-                    version=_version,
-                    msg=str(e)
-                )
-            )
-            pass
+        if not os.path.isdir(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, r)):
+            continue
 
-        cache= CACHE['index'][_repo]
+        cache_add_repo(r)
 
-        del cache['yaml_chart_version'][_chart][_version]
-        del cache['json_chart_version'][_chart][_version]
+        cache=snapshot_load(r)
+        if cache is None:
+            missing.append(r)
+            continue
 
-        if len(cache['yaml_chart_version'][_chart]) == 0:
-            del cache['yaml_chart_version'][_chart]
-            del cache['yaml_chart'][_chart]
-            del cache['json_chart_version'][_chart]
-            del cache['json_chart'][_chart]
-        else:
-            cache_render_chart(cache, _chart)
+        CACHE['index'][r]=cache
+        loaded.append(r)
 
-        cache_render(cache)
+        search_repo_swap(r, None, cache)
 
-        return '{"deleted":true}'
+        shared_publish(r)
 
-    except Exception as e:
-        log_print(
-            'WARNING',
-            'request_delete_api_repo_charts_chart_version({repo}, {chart}, {version}): {msg}'.format(
-                repo=_repo,
-                chart=_chart,
-                version=_version,
-                msg=str(e)
-            )
-        )
-        return ('{"deleted":false}', 404 )
-    finally:    
-        CACHE['mutexes'][_repo].release()
+        if len(cache['blocks_dirty']) > 0:
+            cache_mark_dirty(r)
 
-def request_get_api_repo_charts(_repo):
+    return (loaded, missing)
+
+def snapshot_schedule(_repo):
+    global CHARTHALL_SNAPSHOT
+
+    if not CHARTHALL_SNAPSHOT:
+        return
+
+    CACHE['snapshot_dirty'].add(_repo)
+    CACHE['snapshot_event'].set()
+
+def snapshot_writer():
+    global CHARTHALL_SNAPSHOT_DELAY
+
+    while True:
+        CACHE['snapshot_event'].wait()
+        #coalesce bursts of mutations into a single write
+        time.sleep(CHARTHALL_SNAPSHOT_DELAY)
+        CACHE['snapshot_event'].clear()
+
+        while len(CACHE['snapshot_dirty']) > 0:
+            r=CACHE['snapshot_dirty'].pop()
+
+            if r not in CACHE['mutexes']:
+                continue
+
+            CACHE['mutexes'][r].acquire()
+            try:
+                cache=snapshot_copy(CACHE['index'][r])
+            finally:
+                CACHE['mutexes'][r].release()
+
+            #uploads are not blocked while the repo is marshalled
+            try:
+                payload=snapshot_dumps(cache)
+            except Exception as e:
+                log_print(
+                    'WARNING', 'snapshot_writer({repo}): {msg}'.format(
+                        repo=r,
+                        msg=str(e)
+                    )
+                )
+                continue
+
+            snapshot_write(r, payload)
+
+def parse_size(_size):
+    units={ 'K': 1024, 'M': 1024**2, 'G': 1024**3 }
+
+    size=str(_size).strip().upper()
+    if size[-1:] in units:
+        return int(size[:-1])*units[ size[-1] ]
+
+    return int(size)
+
+def digest_engine_start(_workers, _memory_limit):
+    #every worker owns a single chunk sized buffer, so memory used for
+    #hashing is bounded by _memory_limit no matter how big the charts are
+    workers=max(1, min(_workers, _memory_limit // CHARTHALL_DIGEST_CHUNK_MIN))
+
+    chunk=_memory_limit // workers
+    chunk=max(CHARTHALL_DIGEST_CHUNK_MIN, min(CHARTHALL_DIGEST_CHUNK_MAX, chunk))
+
+    DIGEST['chunk']=chunk
+    DIGEST['engine']=[]
+
+    for i in range(workers):
+        worker=threading.Thread(
+            target=digest_worker,
+            name='digest_{i}'.format(i=i),
+            daemon=True
+        )
+        worker.start()
+
+        DIGEST['engine'].append(worker)
+
+    log_print(
+        'INFO', 'digest engine: {workers} workers, {chunk} bytes chunk'.format(
+            workers=workers,
+            chunk=chunk
+        )
+    )
+
+def digest_worker():
+    condition=DIGEST['condition']
+    queues=DIGEST['queues']
+
+    while True:
+        condition.acquire()
+        try:
+            while len(queues) == 0:
+                condition.wait()
+
+            key=next(iter(queues))
+            queue=queues[key]
+            job, i=queue.popleft()
+
+            #priority repo keeps its place at the front
+            if len(queue) > 0:
+                if key not in DIGEST['priority']:
+                    queues.move_to_end(key)
+            else:
+                del queues[key]
+        finally:
+            condition.release()
+
+        job['results'][i]=calculate_digest(job['data'][i])
+
+        condition.acquire()
+        try:
+            if job['progress'] is not None:
+                job['progress']['hashed']=job['progress']['hashed']+1
+
+            job['remaining']=job['remaining']-1
+            if job['remaining'] == 0:
+                job['done'].set()
+        finally:
+            condition.release()
+
+def digest_buffer():
+    buffer=getattr(DIGEST['buffers'], 'buffer', None)
+
+    if buffer is None or len(buffer) != DIGEST['chunk']:
+        buffer=bytearray(DIGEST['chunk'])
+        DIGEST['buffers'].buffer=buffer
+
+    return buffer
+
+def calculate_digest(_data):   
+
+    try:
+        fp=_data['file_path']
+        m = hashlib.sha256()
+
+        buffer=digest_buffer()
+
+        size=0
+        start=time.perf_counter()
+
+        with memoryview(buffer) as mv, open(fp, "rb", buffering=0) as f:
+            while True:
+                n=f.readinto(mv)
+                if not n:
+                    break
+
+                m.update(mv[:n])
+                size=size+n
+
+        _data['digest']=m.hexdigest()
+
+        metrics_inc('charthall_digest_bytes_total', (), size)
+        metrics_inc('charthall_digest_seconds_total', (), time.perf_counter()-start)
+
+        return _data
+    except Exception as e:
+        return None
+
+def digest_prioritize(_repo):
+    condition=DIGEST['condition']
+
+    condition.acquire()
+    try:
+        DIGEST['priority'].add(_repo)
+
+        if _repo in DIGEST['queues']:
+            DIGEST['queues'].move_to_end(_repo, last=False)
+    finally:
+        condition.release()
+
+def calculate_digest_list(_data_list, _repo=None, _progress=None):
+
+    if len(_data_list) == 0:
+        return []
+
+    if DIGEST['engine'] is None:
+        return [ calculate_digest(d) for d in _data_list ]
+
+    job={
+        'data': _data_list,
+        'results': [ None ]*len(_data_list),
+        'remaining': len(_data_list),
+        'done': threading.Event(),
+        'progress': _progress
+    }
+
+    condition=DIGEST['condition']
+
+    condition.acquire()
+    try:
+        if _repo not in DIGEST['queues']:
+            DIGEST['queues'][_repo]=collections.deque()
+
+            if _repo in DIGEST['priority']:
+                DIGEST['queues'].move_to_end(_repo, last=False)
+
+        DIGEST['queues'][_repo].extend( (job, i) for i in range(len(_data_list)) )
+        condition.notify(len(_data_list))
+    finally:
+        condition.release()
+
+    job['done'].wait()
+
+    return job['results']
+    
+def shared_path(_repo, _suffix):
+    return os.path.join(CHARTHALL_SHARED_DIR, _repo+_suffix)
+
+def shared_publish(_repo):
+    #writes rendered documents of repo for read workers:
+    #magic, header length, json header with offsets, documents
+    if CHARTHALL_SHARED_DIR is None:
+        return
+
+    document=CACHE['index'][_repo]['document']
+
+    if CACHE['shared'].get(_repo) is not document:
+        if _repo not in CACHE['ledger']:
+            CACHE['ledger'][_repo]=ledger_load(_repo)
+
+        header={
+            'generation': document['generation'],
+            'etag': document['etag'],
+            'files': {
+                f: e[3] for f, e in CACHE['ledger'].get(_repo, {}).items()
+            }
+        }
+
+        offset=0
+        for kind in [ 'yaml', 'json' ]:
+            header[kind]={}
+            for encoding in document[kind]:
+                parts, length=document[kind][encoding]
+                header[kind][encoding]=[ offset, length ]
+                offset=offset+length
+
+        header_bytes=json.dumps(header).encode('utf-8')
+
+        file_path=shared_path(_repo, '.doc')
+        tmp_path=file_path+'.tmp'
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(CHARTHALL_SHARED_MAGIC)
+                f.write(struct.pack('<I', len(header_bytes)))
+                f.write(header_bytes)
+
+                for kind in [ 'yaml', 'json' ]:
+                    for encoding in document[kind]:
+                        for p in document_iter(document[kind][encoding][0]):
+                            f.write(p)
+
+            os.replace(tmp_path, file_path)
+            CACHE['shared'][_repo]=document
+
+        except Exception as e:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+            size=len(header_bytes)+offset
+            log_print(
+                'ERROR', 'shared_publish({repo}): {msg}, {size} bytes needed in {dir}, read workers forward requests of the repo to the writer until it is published, see SHARED_DIR'.format(
+                    repo=_repo,
+                    msg=str(e),
+                    size=size,
+                    dir=CHARTHALL_SHARED_DIR
+                )
+            )
+            return
+
+    if _repo not in CACHE['render_dirty'] and _repo not in CACHE['pending']:
+        try:
+            os.remove(shared_path(_repo, '.dirty'))
+        except FileNotFoundError:
+            pass
+
+def cache_rebuild(_repos=None):
+    repos=_repos
+    if repos is None:
+        repos=[]
+        for r in os.listdir(CHARTHALL_STORAGE_LOCAL_ROOTDIR):
+            if not repo_name_valid(r):
+                continue
+
+            if os.path.isdir(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, r)):
+                repos.append(r)
+    
+    log_print('INFO', 'Rebuilding Cache start')
+    for r in repos:
+        cache_add_repo(r)
+
+    #repos are rebuilt side by side sharing the digest engine, every
+    #repo is published as soon as its own rebuild is done
+    if REBUILD['pool'] is None:
+        rebuild_pool_start(CHARTHALL_INDEX_LIMIT)
+
+    list(REBUILD['pool'].map(cache_rebuild_repo, repos))
+
+    log_print('INFO', 'Rebuilding Cache finish')
+
+def rebuild_pool_start(_workers):
+    workers=max(1, _workers)
+
+    if REBUILD['pool'] is not None and REBUILD['workers'] == workers:
+        return
+
+    previous=REBUILD['pool']
+
+    REBUILD['pool']=concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix='rebuild'
+    )
+    REBUILD['workers']=workers
+
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+def cache_rebuild_repo(_repo):
+    try:
+        cache_rebuild_repo_charts(_repo)
+    except Exception as e:
+        log_print(
+            'ERROR', 'cache_rebuild_repo({repo}): {msg}'.format(
+                repo=_repo,
+                msg=str(e)
+            )
+        )
+    
+def loader_start(_repos=None):
+    #every repo is known right away, indexing happens in the background
+    #and a repo somebody asks for is indexed first
+    repos=_repos
+    if repos is None:
+        repos=[]
+        for r in sorted(os.listdir(CHARTHALL_STORAGE_LOCAL_ROOTDIR)):
+            if not repo_name_valid(r):
+                continue
+
+            if os.path.isdir(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, r)):
+                repos.append(r)
+
+    for r in repos:
+        CACHE['pending'][r]=threading.Event()
+        cache_add_repo(r)
+
+        if CHARTHALL_SHARED_DIR is not None:
+            #read workers send requests of the repo to the writer
+            open(shared_path(r, '.dirty'), 'a').close()
+
+    LOADER['queue'].extend(repos)
+
+    log_print('INFO', 'Loading {repos} repos in background'.format(repos=len(repos)))
+
+    if REBUILD['pool'] is None:
+        rebuild_pool_start(CHARTHALL_INDEX_LIMIT)
+
+    #loaders run in the rebuild pool, which lives as long as application
+    for i in range(max(1, min(len(repos), CHARTHALL_INDEX_LIMIT))):
+        REBUILD['pool'].submit(loader_worker)
+
+def loader_worker():
+    condition=LOADER['condition']
+
+    while True:
+        condition.acquire()
+        try:
+            if len(LOADER['queue']) == 0:
+                return
+
+            r=LOADER['queue'].pop(0)
+        finally:
+            condition.release()
+
+        cache_rebuild_repo(r)
+        loader_ready(r)
+
+        if len(CACHE['pending']) == 0:
+            log_print('INFO', 'Loading finished')
+
+def loader_ready(_repo):
+    event=CACHE['pending'].pop(_repo, None)
+
+    if event is not None:
+        event.set()
+
+    condition=DIGEST['condition']
+    condition.acquire()
+    try:
+        DIGEST['priority'].discard(_repo)
+    finally:
+        condition.release()
+
+    if CHARTHALL_SHARED_DIR is not None:
+        #removes the .dirty marker of the repo
+        CACHE['mutexes'][_repo].acquire()
+        try:
+            shared_publish(_repo)
+        finally:
+            CACHE['mutexes'][_repo].release()
+
+def loader_prioritize(_repo):
+    condition=LOADER['condition']
+
+    condition.acquire()
+    try:
+        if _repo in LOADER['queue']:
+            LOADER['queue'].remove(_repo)
+            LOADER['queue'].insert(0, _repo)
+    finally:
+        condition.release()
+
+    digest_prioritize(_repo)
+
+def repo_wait_ready(_repo):
+    #True when the repo can be served, requests of a repo which is not
+    #indexed yet move it to the front and wait up to LOAD_TIMEOUT
+    global CHARTHALL_LOAD_TIMEOUT
+
+    event=CACHE['pending'].get(_repo)
+
+    if event is None:
+        return True
+
+    loader_prioritize(_repo)
+
+    return event.wait(CHARTHALL_LOAD_TIMEOUT)
+
+def cache_add_repo(_repo):
+    #index of repo is published last, whoever finds it finds its locks too
+    if _repo in CACHE['index']:
+        return
+
+    MUTEX.acquire()
+    try:
+        if _repo in CACHE['index']:
+            return
+
+        repo_dir=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR,_repo)
+
+        if not os.path.exists(repo_dir):
+            os.mkdir(repo_dir)
+
+        CACHE['encoding'][_repo] = threading.Lock()
+        CACHE['mutexes'][_repo] = MeteredLock(_repo)
+
+        cache=cache_new(_repo)
+        cache['journal']=[]
+        cache_render(cache)
+
+        CACHE['index'][_repo] = cache
+        shared_publish(_repo)
+
+        str_repos="""---
+repos:
+"""
+        for p in CACHE['mutexes']:
+            str_repos=str_repos+"""- {repo}
+""".format(repo=p)
+
+        CACHE['repos']=str_repos
+    finally:
+        MUTEX.release()
+
+def record_new(_chart, _version, _mtime, _digest):
+    #( chart, version, mtime, digest ) of a chart version, plain tuple keeps
+    #cache marshallable for snapshot, chart names are interned and urls
+    #are not stored at all
+    return (sys.intern(_chart), _version, _mtime, bytes.fromhex(_digest))
+
+def record_created(_record):
+    return datetime.datetime.fromtimestamp(
+        _record[2],
+        tz=datetime.timezone.utc
+    ).strftime("%Y-%m-%dT%H:%M:%S.%f000+00:00")
+
+def record_render(_repo, _record, _kind):
+    global CHARTHALL_CHART_URL
+
+    chart, version, mtime, digest=_record
+
+    if _kind == 'yaml':
+        return """    - apiVersion: v1
+      appVersion: {version}
+      created: "{created}"
+      description: {chart} {version}
+      digest: {digest}
+      name: {chart}
+      urls:
+        - {chart_url}/{repo}/charts/{chart}-{version}.tgz
+      version: {version}""".format(
+            chart=chart,
+            version=version,
+            created=record_created(_record),
+            chart_url=CHARTHALL_CHART_URL,
+            digest=digest.hex(),
+            repo=_repo
+        )
+
+    return '{{"name":"{chart}","version":"{version}","description":"{chart} {version}","apiVersion":"v1","appVersion":"{version}","urls":["{chart_url}/{repo}/charts/{chart}-{version}.tgz"],"created":"{created}","digest":"{digest}"}}'.format(
+        chart=chart,
+        version=version,
+        created=record_created(_record),
+        chart_url=CHARTHALL_CHART_URL,
+        digest=digest.hex(),
+        repo=_repo
+    )
+
+def record_fragment(_repo, _record, _kind):
+    #rendered fragments are kept in a bounded cache shared by all repos
+    global CHARTHALL_FRAGMENT_CACHE
+
+    key=(_kind, _repo, _record)
+    cache=FRAGMENTS['cache']
+
+    FRAGMENTS['lock'].acquire()
+    try:
+        fragment=cache.get(key)
+        if fragment is not None:
+            cache.move_to_end(key)
+            return fragment
+    finally:
+        FRAGMENTS['lock'].release()
+
+    fragment=record_render(_repo, _record, _kind)
+
+    if CHARTHALL_FRAGMENT_CACHE > 0:
+        FRAGMENTS['lock'].acquire()
+        try:
+            cache[key]=fragment
+            while len(cache) > CHARTHALL_FRAGMENT_CACHE:
+                cache.popitem(last=False)
+        finally:
+            FRAGMENTS['lock'].release()
+
+    return fragment
+
+def cache_chart_records(_cache, _chart):
+    #newest version first
+    records=_cache['records'][_chart]
+
+    return tuple(records[v] for v in reversed(_cache['versions'][_chart][1]))
+
+def chart_render(_repo, _chart, _records, _kind):
+    if _kind == 'yaml':
+        return "  "+_chart+":\n"+"\n".join(
+            record_fragment(_repo, r, 'yaml') for r in _records
+        )
+
+    return '['+",".join(
+        record_fragment(_repo, r, 'json') for r in _records
+    )+']'
+
+def cache_render_chart_version(_cache, _repo, _data):
+    #False when the cache already has the same record, e.g. WATCH
+    #reporting a file charthall has just written itself
+    c=_data['chart']
+    v=_data['version']
+    fp=_data['file_path']
+
+    #file may be gone already, chart entry is created only after stat
+    if 'mtime' in _data:
+        os_lstat_st_mtime=_data['mtime']
+    else:
+        os_lstat_st_mtime=os.lstat(fp).st_mtime
+
+    record=record_new(c, v, os_lstat_st_mtime, _data['digest'])
+
+    _data['created_json']=record_created(record)
+
+    if c not in _cache['records']:
+        _cache['records'][c] = {}
+    elif _cache['records'][c].get(v) == record:
+        return False
+
+    if _cache['journal'] is not None:
+        op='add'
+        if v in _cache['records'][c]:
+            op='overwrite'
+
+        cache_journal(_cache, op, c, v, _data['digest'], _data['created_json'])
+        cache_touch(_repo, c, v)
+        search_add(_repo, c)
+
+    if v not in _cache['records'][c]:
+        version_index_add(_cache, c, record[1])
+
+    _cache['records'][c][v]=record
+
+    return True
+
+def cache_new(_repo):
+    return {
+        'repo': _repo,
+        # { chart: { version: record } }, index is rendered from records
+        'records': {},
+        #rendered index is kept as blocks of charts, change of a chart
+        #re-renders only the block it belongs to
+        'blocks': {},
+        'block_order': [],
+        'block_next': 0,
+        'chart_block': {},
+        'blocks_dirty': set(),
+        #versions of every chart sorted by semver precedence
+        'versions': {},
+        #names of charts, sorted
+        'charts': [],
+        #[ generation, op, chart, version, digest, created ], only live
+        #caches keep a journal, caches being rebuilt have None
+        'journal': None,
+        'journal_pending': [],
+        'journal_start': 0
+    }
+
+def cache_journal(_cache, _op, _chart, _version, _digest=None, _created=None):
+    #called with repo mutex held, event gets generation of the render
+    #which publishes it
+    if _cache['journal'] is None:
+        return
+
+    _cache['journal_pending'].append([ _op, _chart, _version, _digest, _created ])
+
+def cache_touch(_repo, _chart, _version):
+    #called with repo mutex held on every change of live cache
+    touched=CACHE['rebuilding'].get(_repo)
+
+    if touched is not None:
+        touched.add(_chart+'-'+_version+'.tgz')
+
+def cache_journal_publish(_cache):
+    global CHARTHALL_JOURNAL_SIZE
+
+    journal=_cache['journal']
+
+    if journal is None:
+        return
+
+    for e in _cache['journal_pending']:
+        journal.append([ _cache['generation'] ]+e)
+
+    _cache['journal_pending']=[]
+
+    #journal covers all changes after journal_start
+    over=len(journal)-CHARTHALL_JOURNAL_SIZE
+    if over > 0:
+        _cache['journal_start']=journal[over-1][0]
+        del journal[:over]
+
+def cache_journal_diff(_previous, _cache):
+    #events turning _previous into _cache, used when rebuild swaps caches
+    events=[]
+
+    for c in _cache['records']:
+        previous=_previous['records'].get(c, {})
+
+        for v, record in _cache['records'][c].items():
+            if v not in previous:
+                op='add'
+            elif previous[v] != record:
+                op='overwrite'
+            else:
+                continue
+
+            events.append([ op, c, v, record[3].hex(), record_created(record) ])
+
+    for c in _previous['records']:
+        current=_cache['records'].get(c, {})
+
+        for v in _previous['records'][c]:
+            if v not in current:
+                events.append([ 'delete', c, v, None, None ])
+
+    return events
+
+def cache_block_assign(_cache, _chart):
+    global CHARTHALL_RENDER_BLOCK
+
+    if _chart in _cache['chart_block']:
+        _cache['blocks_dirty'].add(_cache['chart_block'][_chart])
+        return
+
+    order=_cache['block_order']
+
+    if len(order) == 0 or len(_cache['blocks'][ order[-1] ]['charts']) >= CHARTHALL_RENDER_BLOCK:
+        bid=_cache['block_next']
+        _cache['block_next']=bid+1
+        _cache['blocks'][bid]={ 'charts': [] }
+        order.append(bid)
+
+    bid=order[-1]
+    _cache['blocks'][bid]['charts'].append(_chart)
+    _cache['chart_block'][_chart]=bid
+    _cache['blocks_dirty'].add(bid)
+
+    bisect.insort(_cache['charts'], _chart)
+
+def cache_block_remove(_cache, _chart):
+    bid=_cache['chart_block'].pop(_chart)
+    block=_cache['blocks'][bid]
+
+    i=bisect.bisect_left(_cache['charts'], _chart)
+    del _cache['charts'][i]
+
+    block['charts'].remove(_chart)
+
+    if len(block['charts']) > 0:
+        _cache['blocks_dirty'].add(bid)
+        return
+
+    del _cache['blocks'][bid]
+    _cache['block_order'].remove(bid)
+    _cache['blocks_dirty'].discard(bid)
+
+def cache_render_chart(_cache, _chart):
+    #chart is rendered from its records together with its block
+    cache_block_assign(_cache, _chart)
+
+def cache_remove_chart(_cache, _chart):
+    del _cache['records'][_chart]
+    _cache['versions'].pop(_chart, None)
+
+    cache_block_remove(_cache, _chart)
+
+def cache_encode(_data):
+    #every block is compressed on its own into raw deflate ending on a full
+    #flush, segments of all blocks are joined into a single gzip member
+    compressor=zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return {
+        'gzip': (
+            compressor.compress(_data)+compressor.flush(zlib.Z_FULL_FLUSH),
+            zlib.crc32(_data),
+            len(_data)
+        )
+    }
+
+def gzip_join(_segments):
+    #( segment, crc32, length ) of blocks into gzip header, segments, empty
+    #final deflate block and trailer, crc32 of the whole document is
+    #combined from crc32 of blocks
+    crc=0
+    size=0
+
+    for segment, segment_crc, length in _segments:
+        zeros=bytes(length)
+        crc=zlib.crc32(zeros, crc)^segment_crc^zlib.crc32(zeros)
+        size=size+length
+
+    parts=[ CHARTHALL_GZIP_HEADER ]
+    parts.extend(s[0] for s in _segments)
+    parts.append(b'\x03\x00'+struct.pack('<II', crc, size & 0xffffffff))
+
+    return (tuple(parts), sum(len(p) for p in parts))
+
+def cache_encode_constant(_data):
+    if _data not in RENDER_CONSTANTS:
+        RENDER_CONSTANTS[_data]=cache_encode(_data)
+
+    return RENDER_CONSTANTS[_data]
+
+def cache_render_blocks(_cache):
+    global CHARTHALL_INDEX_STREAMING
+
+    repo=_cache['repo']
+
+    for bid in _cache['blocks_dirty']:
+        block=_cache['blocks'][bid]
+
+        records=tuple(
+            (c, cache_chart_records(_cache, c)) for c in block['charts']
+        )
+
+        yaml_block="".join(
+            chart_render(repo, c, r, 'yaml')+"\n" for c, r in records
+        ).encode('utf-8')
+
+        json_block=",".join(
+            '"'+c+'": '+chart_render(repo, c, r, 'json') for c, r in records
+        ).encode('utf-8')
+
+        block['yaml']=yaml_block
+        block['json']=json_block
+        block['digest']={
+            'yaml': hashlib.sha256(yaml_block).digest(),
+            'json': hashlib.sha256(json_block).digest()
+        }
+        block.pop('encoded', None)
+
+        if CHARTHALL_INDEX_STREAMING:
+            #keep only compressed block, it is inflated again while
+            #uncompressed document is being sent
+            block['encoded']={
+                'yaml': cache_encode(yaml_block),
+                'json': cache_encode(json_block)
+            }
+            block['yaml']=( block['encoded']['yaml']['gzip'][0], len(yaml_block) )
+            block['json']=( block['encoded']['json']['gzip'][0], len(json_block) )
+
+    _cache['blocks_dirty']=set()
+
+def cache_fingerprint(_cache):
+    #json carries the same entries as yaml without generated timestamp, so it
+    #tells whether content changed since the last render
+    m=hashlib.sha256()
+
+    for bid in _cache['block_order']:
+        m.update(_cache['blocks'][bid]['digest']['json'])
+
+    return m.hexdigest()[:32]
+
+def document_part_length(_part):
+    if isinstance(_part, tuple):
+        return _part[1]
+
+    return len(_part)
+
+def document_iter(_parts):
+    #parts are bytes or ( deflate segment, length ) of a streamed block
+    for p in _parts:
+        if not isinstance(p, tuple):
+            yield p
+            continue
+
+        yield zlib.decompressobj(-zlib.MAX_WBITS).decompress(p[0])
+
+def cache_render_document(_parts):
+    #_parts are either constant bytes or (block, encoded) tuples
+    document={}
+
+    for encoding in CHARTHALL_ENCODINGS:
+        if encoding in CHARTHALL_ENCODINGS_WHOLE:
+            continue
+
+        parts=[]
+        for p in _parts:
+            if not isinstance(p, tuple):
+                p=(p, cache_encode_constant(p))
+
+            if encoding == 'identity':
+                parts.append(p[0])
+            elif encoding in p[1]:
+                parts.append(p[1][encoding])
+            else:
+                #block encoded without it, response_encoded() falls back
+                parts=None
+                break
+
+        if parts is None:
+            continue
+
+        if encoding == 'gzip':
+            document[encoding]=gzip_join(parts)
+            continue
+
+        document[encoding]=(
+            tuple(parts),
+            sum(document_part_length(p) for p in parts)
+        )
+
+    return document
+
+def cache_render(_cache):
+
+    cache_render_blocks(_cache)
+
+    fingerprint=cache_fingerprint(_cache)
+
+    if fingerprint == _cache.get('fingerprint') and 'document' in _cache:
+        #changes cancelled each other out
+        _cache['journal_pending']=[]
+        return
+
+    now_generated=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+    footer="""generated: "{generated}"
+serverInfo: {{}}
+""".format(
+        generated=now_generated
+    ).encode('utf-8')
+
+    blocks=[ _cache['blocks'][bid] for bid in _cache['block_order'] ]
+
+    #compressed once per change of a block instead of once per request
+    for block in blocks:
+        if 'encoded' not in block:
+            block['encoded']={
+                'yaml': cache_encode(block['yaml']),
+                'json': cache_encode(block['json'])
+            }
+
+    yaml_parts=[]
+    json_parts=[ b'{' ]
+
+    if len(blocks) == 0:
+        yaml_parts.append(b'apiVersion: v1\nentries: {}\n')
+    else:
+        yaml_parts.append(b'apiVersion: v1\nentries:\n')
+
+    for i, block in enumerate(blocks):
+        yaml_parts.append( (block['yaml'], block['encoded']['yaml']) )
+
+        if i > 0:
+            json_parts.append(b',')
+        json_parts.append( (block['json'], block['encoded']['json']) )
+
+    yaml_parts.append( (footer, cache_encode(footer)) )
+    json_parts.append(b'}')
+
+    m=hashlib.sha256(footer)
+    for block in blocks:
+        m.update(block['digest']['yaml'])
+
+    _cache['fingerprint']=fingerprint
+    _cache['generation']=_cache.get('generation', 0)+1
+
+    cache_journal_publish(_cache)
+
+    #published with a single assignment, readers never see a mix of two renders
+    _cache['document']={
+        'generation': _cache['generation'],
+        'etag': {
+            'yaml': m.hexdigest()[:32],
+            'json': fingerprint
+        },
+        'yaml': cache_render_document(yaml_parts),
+        'json': cache_render_document(json_parts)
+    }
+
+def cache_mark_dirty(_repo):
+    #called with repo mutex held, rendering is left to the next reader
+    #or to render_on_delay(), so bursts of uploads pay for a single render
+    global CHARTHALL_RENDER_DELAY
+
+    CACHE['render_dirty'].add(_repo)
+
+    if CHARTHALL_SHARED_DIR is not None:
+        #read workers send index requests of dirty repo to the writer
+        open(shared_path(_repo, '.dirty'), 'a').close()
+
+    if CHARTHALL_RENDER_DELAY > 0:
+        CACHE['render_event'].set()
+
+def cache_render_pending(_repo):
+    if _repo not in CACHE['render_dirty']:
+        return
+
+    #only one render per repo at a time, other readers keep getting
+    #the last complete document
+    MUTEX.acquire()
+    try:
+        if _repo in CACHE['rendering']:
+            return
+
+        CACHE['rendering'].add(_repo)
+    finally:
+        MUTEX.release()
+
+    try:
+        CACHE['mutexes'][_repo].acquire()
+        try:
+            if _repo in CACHE['render_dirty']:
+                start=time.perf_counter()
+                cache_render(CACHE['index'][_repo])
+                timing_add('render', time.perf_counter()-start)
+                CACHE['render_dirty'].discard(_repo)
+                snapshot_schedule(_repo)
+                shared_publish(_repo)
+        finally:
+            CACHE['mutexes'][_repo].release()
+    finally:
+        CACHE['rendering'].discard(_repo)
+
+def render_on_delay():
+    global CHARTHALL_RENDER_DELAY
+
+    while True:
+        CACHE['render_event'].wait()
+        time.sleep(CHARTHALL_RENDER_DELAY)
+        CACHE['render_event'].clear()
+
+        for r in list(CACHE['render_dirty']):
+            try:
+                cache_render_pending(r)
+            except Exception as e:
+                log_print(
+                    'ERROR', 'render_on_delay({repo}): {msg}'.format(
+                        repo=r,
+                        msg=str(e)
+                    )
+                )
+
+def cache_rebuild_repo_charts(_repo):
+    #scanning, hashing and rendering run without repo mutex, changes made
+    #meanwhile are recorded by cache_touch() and merged in under the mutex
+
+#    log_print('INFO:','cache_rebuild_repo_charts('+ _repo+') start')
+
+    start=time.perf_counter()
+
+    repo_path = os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo )
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        if _repo in CACHE['rebuilding']:
+            return
+
+        CACHE['rebuilding'][_repo]=set()
+
+        if _repo not in CACHE['ledger']:
+            CACHE['ledger'][_repo]=ledger_load(_repo)
+
+        ledger=dict(CACHE['ledger'][_repo])
+    finally:
+        CACHE['mutexes'][_repo].release()
+
+    try:
+        ledger_new={}
+        
+        cache=cache_new(_repo)
+
+        d_list=[]
+        c_list=[]
+        stats={}
+
+        with os.scandir(repo_path) as entries:
+            for e in entries:
+                f=e.name
+
+                if not f.endswith('.tgz'):
+                    continue
+
+                if not e.is_file():
+                    continue
+
+                data=extract_name_version(
+                    f.replace('.tgz','')
+                )
+
+                if data is not None and data['version'] == '':
+                    continue
+
+                try:
+                    st=e.stat()
+                except Exception:
+                    continue
+
+                data['file_path']=e.path
+                data['filename']=f
+                data['mtime']=st.st_mtime
+
+                stats[f]=st
+                d_list.append(data)
+
+                if not ledger_match(ledger.get(f), st):
+                    c_list.append(data)
+                    continue
+
+                data['digest']=ledger[f][3]
+                ledger_new[f]=ledger[f]
+
+        progress={ 'files': len(d_list), 'to_hash': len(c_list), 'hashed': 0 }
+        CACHE['progress'][_repo]=progress
+
+        if len(c_list) > 0:
+            for d in calculate_digest_list(c_list, _repo, progress):
+                if d is None:
+                    continue
+
+                ledger_new[ d['filename'] ]=ledger_entry(stats[ d['filename'] ], d['digest'])
+
+        for d in d_list:
+            if d['filename'] not in ledger_new:
+                continue
+
+            d['digest']=ledger_new[ d['filename'] ][3]
+
+            cache_render_chart_version(cache, _repo, d)
+
+        for c in cache['records']:
+            cache_render_chart(cache, c)
+
+        cache_render_blocks(cache)
+
+        CACHE['mutexes'][_repo].acquire()
+        try:
+            cache_rebuild_merge(_repo, cache, ledger_new, CACHE['rebuilding'][_repo])
+            cache_rebuild_swap(_repo, cache, ledger_new, ledger)
+        finally:
+            CACHE['mutexes'][_repo].release()
+
+    finally:
+        CACHE['rebuilding'].pop(_repo, None)
+
+    if len(c_list) > 0:
+        log_print(
+            'INFO', 'cache_rebuild_repo_charts({repo}): {files} charts, {hashed} hashed'.format(
+                repo=_repo,
+                files=len(ledger_new),
+                hashed=len(c_list)
+            )
+        )
+
+    metrics_observe('charthall_rebuild_duration_seconds', (('repo', _repo),), time.perf_counter()-start)
+    metrics_inc('charthall_rebuild_files_hashed_total', (('repo', _repo),), len(c_list))
+
+#    log_print('INFO:','cache_rebuild_repo_charts('+ _repo+') finish')
+
+def cache_rebuild_merge(_repo, _cache, _ledger_new, _touched):
+    #called with repo mutex held, live cache is right about every chart
+    #changed during rebuild, whatever the scan has seen of it
+    if len(_touched) == 0:
+        return
+
+    previous=CACHE['index'][_repo]
+    ledger=CACHE['ledger'].get(_repo, {})
+
+    charts=set()
+
+    for f in _touched:
+        data=extract_name_version(f.replace('.tgz',''))
+        c=data['chart']
+        v=data['version']
+
+        if c in _cache['records'] and v in _cache['records'][c]:
+            del _cache['records'][c][v]
+            version_index_remove(_cache, c, v)
+
+        if c in previous['records'] and v in previous['records'][c]:
+            if c not in _cache['records']:
+                _cache['records'][c]={}
+
+            _cache['records'][c][v]=previous['records'][c][v]
+            version_index_add(_cache, c, _cache['records'][c][v][1])
+
+        if f in ledger:
+            _ledger_new[f]=ledger[f]
+        else:
+            _ledger_new.pop(f, None)
+
+        charts.add(c)
+
+    for c in charts:
+        if c not in _cache['records']:
+            continue
+
+        if len(_cache['records'][c]) == 0:
+            if c in _cache['chart_block']:
+                cache_remove_chart(_cache, c)
+            else:
+                del _cache['records'][c]
+        else:
+            cache_render_chart(_cache, c)
+
+    cache_render_blocks(_cache)
+
+def cache_rebuild_swap(_repo, _cache, _ledger_new, _ledger):
+    #called with repo mutex held
+    previous=CACHE['index'].get(_repo)
+
+    #unchanged content keeps previous cache with its generation and etag
+    if previous is None or previous.get('fingerprint') != cache_fingerprint(_cache):
+        if previous is not None:
+            _cache['generation']=previous.get('generation', 0)
+
+            if previous['journal'] is not None:
+                _cache['journal']=previous['journal']
+                _cache['journal_start']=previous['journal_start']
+                _cache['journal_pending']=previous['journal_pending']+cache_journal_diff(previous, _cache)
+
+        cache_render(_cache)
+
+        CACHE['index'][_repo]=_cache
+        CACHE['render_dirty'].discard(_repo)
+
+        search_repo_swap(_repo, previous, _cache)
+
+    CACHE['ledger'][_repo]=_ledger_new
+    shared_publish(_repo)
+
+    snapshot_schedule(_repo)
+
+    if _ledger_new != _ledger or _repo in CACHE['ledger_dirty']:
+        CACHE['ledger_dirty'].discard(_repo)
+        ledger_save(_repo, _ledger_new)
+
+def put_file_check(_repo, _extension, _filename):
+    global CHARTHALL_ALLOW_OVERWRITE
+
+    if not repo_name_valid(_repo):
+        raise Exception('invalid repo name '+_repo)
+
+    basename=os.path.basename(_filename)
+    data=extract_name_version(basename.replace(_extension,''))
+
+    repo_dir = os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR,_repo)
+    file_path=os.path.join(repo_dir,basename)
+
+    if CHARTHALL_ALLOW_OVERWRITE == False \
+        and _repo in CACHE['index'] \
+        and data['chart'] in CACHE['index'][_repo]['records'] \
+        and data['version'] in CACHE['index'][_repo]['records'][ data['chart'] ]:
+        raise Exception("chart overwriting not allowed "+file_path)
+
+    if not basename.endswith(_extension):
+        raise Exception('incorrect extension('+_extension+') '+basename)
+
+    if data['version']=='':
+        raise Exception('non semantic versioning '+basename)
+
+    data['filename']=basename
+    data['file_path']=file_path
+
+    return data
+
+def storage_write(_file_path, _src, _digest=None, _mtime_ns=None):
+    #file is written next to its final place while digest is calculated
+    #and renamed when complete, so neither a reader nor rebuild ever sees
+    #a partial chart and the file is not read again
+    global CHARTHALL_FSYNC
+
+    dir_path=os.path.dirname(_file_path)
+    tmp_path=os.path.join(
+        dir_path,
+        '.{file}.{thread}.tmp'.format(
+            file=os.path.basename(_file_path),
+            thread=threading.get_ident()
+        )
+    )
+
+    m=hashlib.sha256()
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                data=_src.read(DIGEST['chunk'])
+                if not data:
+                    break
+                m.update(data)
+                f.write(data)
+
+            if CHARTHALL_FSYNC != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+
+        if _digest is not None and m.hexdigest() != _digest:
+            raise Exception('digest mismatch, expected {expected}, got {got}'.format(
+                expected=_digest,
+                got=m.hexdigest()
+            ))
+
+        if _mtime_ns is not None:
+            os.utime(tmp_path, ns=(_mtime_ns, _mtime_ns))
+
+        os.replace(tmp_path, _file_path)
+
+        if CHARTHALL_FSYNC == 'always':
+            fd=os.open(dir_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return m.hexdigest()
+
+def put_file(_repo, _extension, _req_file):
+    
+    if _req_file is None:
+        return
+
+    data=put_file_check(_repo, _extension, _req_file.filename)
+
+    data['digest']=storage_write(data['file_path'], _req_file.stream)
+
+    if _extension == '.tgz':
+        ledger_update(_repo, data)
+        metrics_upload(_repo, data)
+
+    return data
+
+def metrics_upload(_repo, _data):
+    entry=CACHE['ledger'][_repo].get(_data['filename'])
+
+    metrics_inc('charthall_uploads_total', (('repo', _repo),))
+    if entry is not None:
+        metrics_inc('charthall_upload_bytes_total', (('repo', _repo),), entry[1])
+
+def put_file_extension(_filename):
+    if _filename.endswith('.tgz.prov'):
+        return '.tgz.prov'
+
+    if _filename.endswith('.tgz'):
+        return '.tgz'
+
+    raise Exception('incorrect extension '+_filename)
+
+def put_files(_repo, _items, _results):
+    #_items yields (filename, stream) pairs, files are written one by one
+    #with digest calculated while writing, result of every file is appended
+    #to _results right away, so it is known even when _items breaks
+    for filename, src in _items:
+        result={ 'file': os.path.basename(filename), 'saved': False }
+        _results.append(result)
+
+        try:
+            extension=put_file_extension(filename)
+            data=put_file_check(_repo, extension, filename)
+
+            data['digest']=storage_write(data['file_path'], src)
+
+            if extension == '.tgz':
+                ledger_update(_repo, data)
+                metrics_upload(_repo, data)
+
+                cache=CACHE['index'][_repo]
+
+                if cache_render_chart_version(cache, _repo, data):
+                    cache_render_chart(cache, data['chart'])
+
+            result['saved']=True
+
+        except Exception as e:
+            result['error']=str(e)
+
+def put_files_multipart(_files):
+    for field in _files:
+        for f in _files.getlist(field):
+            yield (f.filename, f.stream)
+
+def put_files_tar(_stream):
+    with tarfile.open(fileobj=_stream, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            yield (member.name, tar.extractfile(member))
+
+def cache_remove_chart_version(_repo, _chart, _version):
+    #called with repo mutex held, files are not touched
+    cache= CACHE['index'][_repo]
+
+    del cache['records'][_chart][_version]
+    version_index_remove(cache, _chart, _version)
+
+    cache_journal(cache, 'delete', _chart, _version)
+    cache_touch(_repo, _chart, _version)
+
+    if _repo in CACHE['ledger']:
+        CACHE['ledger'][_repo].pop(_chart+'-'+_version+'.tgz', None)
+        CACHE['ledger_dirty'].add(_repo)
+
+    if len(cache['records'][_chart]) == 0:
+        cache_remove_chart(cache, _chart)
+        search_remove(_repo, _chart)
+    else:
+        cache_render_chart(cache, _chart)
+
+    cache_mark_dirty(_repo)
+
+def cache_delete_chart_version(_repo, _chart, _version):
+    #called with repo mutex held
+    if _chart not in CACHE['index'][_repo]['records']:        
+        raise Exception('chart not in repo')
+
+    if _version not in CACHE['index'][_repo]['records'][_chart]:
+        raise Exception('version not in chart in project')
+
+    try:            
+        os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _chart+'-'+_version+'.tgz'))
+        os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _chart+'-'+_version+'.tgz.prov'))
+    except Exception as e:
+        log_print(
+            'WARNING', 
+            'cache_delete_chart_version({repo}, {chart}, {version}): {msg}'.format(
+                repo=_repo,
+                chart=_chart,
+                version=_version,
+                msg=str(e)
+            )
+        )
+        pass
+
+    cache_remove_chart_version(_repo, _chart, _version)
+
+def cache_apply_file(_repo, _filename):
+    #brings cache of a single chart in line with the filesystem,
+    #used for files changed by something else than charthall
+    if not _filename.endswith('.tgz'):
+        return
+
+    data=extract_name_version(_filename.replace('.tgz',''))
+
+    if data['version'] == '':
+        return
+
+    file_path=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _filename)
+
+    data['filename']=_filename
+    data['file_path']=file_path
+
+    try:
+        st=os.stat(file_path)
+    except FileNotFoundError:
+        st=None
+
+    if st is not None:
+        if _repo not in CACHE['ledger']:
+            CACHE['ledger'][_repo]=ledger_load(_repo)
+
+        entry=CACHE['ledger'][_repo].get(_filename)
+
+        #hashing is done without holding repo mutex
+        if ledger_match(entry, st):
+            data['digest']=entry[3]
+        elif calculate_digest(data) is None:
+            return
+
+    cache_add_repo(_repo)
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        cache=CACHE['index'][_repo]
+
+        if st is None:
+            if data['chart'] in cache['records'] \
+                and data['version'] in cache['records'][ data['chart'] ]:
+                cache_remove_chart_version(_repo, data['chart'], data['version'])
+            return
+
+        #file changed again while it was hashed, next event will bring it
+        if not ledger_match(ledger_entry(st, None), os.stat(file_path)):
+            return
+
+        data['mtime']=st.st_mtime
+
+        CACHE['ledger'][_repo][_filename]=ledger_entry(st, data['digest'])
+        CACHE['ledger_dirty'].add(_repo)
+
+        if cache_render_chart_version(cache, _repo, data):
+            cache_render_chart(cache, data['chart'])
+            cache_mark_dirty(_repo)
+
+    except FileNotFoundError:
+        pass
+    finally:
+        CACHE['mutexes'][_repo].release()
+
+################ REQUESTS ################
+def document_compress(_encoding, _data):
+    if _encoding == 'br':
+        return brotli.compress(_data, quality=5)
+
+    return zstandard.ZstdCompressor(level=10).compress(_data)
+
+def response_encoded_whole(_cache, _document, _kind, _encoding):
+    #brotli and zstd are sent as a single stream of the whole document,
+    #compressed on first request after it changed
+    key=(_kind, _encoding)
+
+    generation, data=_cache.get('document_encoded', {}).get(key, (None, None))
+
+    if generation == _document['generation']:
+        return ((data,), len(data))
+
+    #single flight, concurrent requests wait for the first one to compress
+    CACHE['encoding'][_cache['repo']].acquire()
+    try:
+        generation, data=_cache.get('document_encoded', {}).get(key, (None, None))
+
+        if generation != _document['generation']:
+            parts, length=_document[_kind]['identity']
+
+            generation=_document['generation']
+
+            start=time.perf_counter()
+            data=document_compress(_encoding, b''.join(document_iter(parts)))
+            timing_add('encode', time.perf_counter()-start)
+
+            if 'document_encoded' not in _cache:
+                _cache['document_encoded']={}
+            _cache['document_encoded'][key]=(generation, data)
+    finally:
+        CACHE['encoding'][_cache['repo']].release()
+
+    return ((data,), len(data))
+
+def response_encoded(_cache, _kind):
+    document=_cache['document']
+
+    encoding=request.accept_encodings.best_match(
+        [ e for e in CHARTHALL_ENCODINGS if e in CHARTHALL_ENCODINGS_WHOLE or e in document[_kind] ],
+        default='identity'
+    )
+
+    headers={
+        'Vary': 'Accept-Encoding',
+        'X-Charthall-Generation': str(document['generation']),
+        'ETag': '"{etag}-{encoding}"'.format(
+            etag=document['etag'][_kind],
+            encoding=encoding
+        )
+    }
+
+    if request.if_none_match.contains_weak(headers['ETag'][1:-1]):
+        return ('', 304, headers)
+
+    if encoding in CHARTHALL_ENCODINGS_WHOLE:
+        parts, length=response_encoded_whole(_cache, document, _kind, encoding)
+    else:
+        parts, length=document[_kind][encoding]
+
+    if encoding != 'identity':
+        headers['Content-Encoding']=encoding
+
+    headers['Content-Length']=str(length)
+
+    #document is an immutable tuple of parts, sent without joining them
+    return Response(document_iter(parts), 200, headers)
+
+def request_post_api_repo_charts(_repo, _req_chart, _req_prov):
+            
+    if _req_chart is None:
+        return ('{"saved":false}', 400)
+
+    if not repo_name_valid(_repo):
+        return ('{"saved":false}', 400)
+    
+    try:
+        cache_add_repo(_repo)
+        
+        CACHE['mutexes'][_repo].acquire()
+
+        cache=CACHE['index'][_repo]
+
+        data=put_file(_repo, '.tgz', _req_chart)
+        if _req_prov is not None:
+            put_file(_repo, '.tgz.prov', _req_prov)
+        
+        if cache_render_chart_version(cache, _repo, data):
+            cache_render_chart(cache, data['chart'])
+            cache_mark_dirty(_repo)
+        
+    except Exception as e:
+        log_print(
+            'ERROR', 'request_post_api_repo_charts({repo}): {msg}'.format(
+                repo=_repo,
+                msg=str(e)
+            )
+        )
+        return('{"saved":false}', 400)
+    finally:
+        CACHE['mutexes'][_repo].release()
+            
+    return ('{"saved":true}', 201)
+
+def request_post_api_repo_bulk(_repo, _items):
+
+    if not repo_name_valid(_repo):
+        return ('{"error":"invalid repo name"}', 400)
+
+    cache_add_repo(_repo)
+
+    results=[]
+    error=None
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        put_files(_repo, _items, results)
+    except Exception as e:
+        #e.g. broken tar stream, files saved before are kept
+        error=str(e)
+        log_print(
+            'ERROR', 'request_post_api_repo_bulk({repo}): {msg}'.format(
+                repo=_repo,
+                msg=error
+            )
+        )
+    finally:
+        #only saved charts change the index, prov files are not in it
+        if any(r['saved'] and r['file'].endswith('.tgz') for r in results):
+            cache_mark_dirty(_repo)
+        CACHE['mutexes'][_repo].release()
+
+    document={ 'results': results }
+    if error is not None:
+        document['error']=error
+        return (json.dumps(document), 400)
+
+    return (json.dumps(document), 200)
+
+def request_delete_api_repo_bulk(_repo, _items):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    if not isinstance(_items, list):
+        return ('{"error":"list of chart/version pairs expected"}', 400)
+
+    results=[]
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        for item in _items:
+            result={ 'chart': None, 'version': None, 'deleted': False }
+            results.append(result)
+
+            try:
+                if not isinstance(item, dict) or 'chart' not in item or 'version' not in item:
+                    raise Exception('chart and version expected')
+
+                result['chart']=item['chart']
+                result['version']=item['version']
+
+                cache_delete_chart_version(_repo, item['chart'], item['version'])
+
+                result['deleted']=True
+            except Exception as e:
+                result['error']=str(e)
+    finally:
+        CACHE['mutexes'][_repo].release()
+
+    return (json.dumps({ 'results': results }), 200)
+
+def request_post_api_repo_prov(_repo, _req_prov):
+
+    if _req_prov is None:
+        return ('{"saved":false}', 400)
+
+    try:
+        put_file(_repo, '.tgz.prov', _req_prov)
+    except Exception as e:
+        log_print(
+            'ERROR', 'request_post_api_repo_prov({repo}): {msg}'.format(
+                repo=_repo,
+                msg=str(e)
+            )
+        )
+        return('{"saved":false}', 400)
+
+    return ('{"saved":true}', 201)
+
+def request_get_repo_charts_file(_repo, _file, _etag=None):
+    try:
+        mimetype='text/plain; charset=utf-8'
+
+        if _file.endswith('.tgz'):
+            mimetype='application/x-tar'
+
+        if not repo_name_valid(_repo):
+            raise Exception('invalid repo name')
+
+        file_path=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _file)        
+
+        #digest is already known for indexed charts, for anything else
+        #werkzeug derives etag from mtime and size
+        etag=True
+        if _etag is not None:
+            etag=_etag
+        elif _repo in CACHE['ledger'] and _file in CACHE['ledger'][_repo]:
+            etag=CACHE['ledger'][_repo][_file][3]
+
+        #file is passed by path, so the body is streamed with wsgi.file_wrapper
+        #and conditional takes care of If-None-Match, If-Modified-Since and Range
+        return send_file(
+            file_path,
+            as_attachment=True,
+            download_name=_file,
+            mimetype=mimetype,
+            conditional=True,
+            etag=etag
+        )
+
+    except FileNotFoundError:
+        #not an error, e.g. helm --verify and followers ask for .prov
+        #of charts which have none
+        return '{"error": "not found"}',404,{ 'Content-Type':'application/json; charset=utf-8'}
+
+    except Exception as e:
+        log_print(
+            'ERROR',
+            'request_get_repo_charts_file({repo}, {file}): {msg}'.format(
+                repo=_repo,
+                file=_file,
+                msg=str(e)
+            )
+        )
+        return '{"error": "not found"}',404,{ 'Content-Type':'application/json; charset=utf-8'}
+
+def request_delete_api_repo_charts_chart_version(_repo, _chart, _version):
+    if _repo not in CACHE['index']:
+        log_print(
+            'WARNING', 
+            'request_delete_api_repo_charts_chart_version({repo}, {chart}, {version}): repo() does not exist'.format(
+                repo=_repo,
+                chart=_chart,
+                version=_version
+            )
+        )
+        return ('{"deleted":false}', 404 )
+    
+    CACHE['mutexes'][_repo].acquire()
+
+    try: 
+        cache_delete_chart_version(_repo, _chart, _version)
+
+        return '{"deleted":true}'
+
+    except Exception as e:
+        log_print(
+            'WARNING',
+            'request_delete_api_repo_charts_chart_version({repo}, {chart}, {version}): {msg}'.format(
+                repo=_repo,
+                chart=_chart,
+                version=_version,
+                msg=str(e)
+            )
+        )
+        return ('{"deleted":false}', 404 )
+    finally:    
+        CACHE['mutexes'][_repo].release()
+
+def request_get_api_repo_charts(_repo):
     if _repo not in CACHE['index']:        
         return ('{}', 200)
 
-    return CACHE['index'][_repo]['json']
+    cache_render_pending(_repo)
+
+    return response_encoded(CACHE['index'][_repo], 'json')
+
+def request_get_api_repo_charts_page(_repo, _limit, _cursor, _prefix, _q):
+    #page of charts ordered by name, same document as the whole list,
+    #name of the last chart is the cursor of the next page
+    global CHARTHALL_PAGE_LIMIT
+
+    if _repo not in CACHE['index']:
+        return ('{}', 200)
+
+    limit=_limit
+    if limit is None or limit > CHARTHALL_PAGE_LIMIT:
+        limit=CHARTHALL_PAGE_LIMIT
+
+    if limit < 1:
+        return ('{"error":"limit has to be positive"}', 400)
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        cache=CACHE['index'][_repo]
+        charts=cache['charts']
+
+        q=None
+        if _q is not None and _q != '':
+            q=_q.lower()
+
+        if q is not None:
+            #charts containing q come from the search index, sorted they
+            #are bisected just like the list of all charts
+            charts=sorted(
+                c for r, c in search_find(q) if r == _repo and c in cache['records']
+            )
+
+        lo=0
+        hi=len(charts)
+
+        if _prefix is not None and _prefix != '':
+            lo=bisect.bisect_left(charts, _prefix)
+            hi=bisect.bisect_left(charts, _prefix+'\U0010ffff')
+
+        if _cursor is not None and _cursor != '':
+            lo=max(lo, bisect.bisect_right(charts, _cursor))
+
+        page=charts[lo:min(hi, lo+limit)]
+
+        cursor=None
+        if lo+limit < hi:
+            cursor=page[-1]
+
+        body='{'+",".join(
+            '"'+c+'": '+chart_render(_repo, c, cache_chart_records(cache, c), 'json') for c in page
+        )+'}'
+    finally:
+        CACHE['mutexes'][_repo].release()
+
+    headers={}
+    if cursor is not None:
+        headers['X-Next-Cursor']=urllib.parse.quote(cursor, safe='')
+
+    return (body, 200, headers)
+
+def request_head_api_repo_charts_chart(_repo, _chart):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    if _chart not in CACHE['index'][_repo]['records']:
+        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+
+    return ('{}', 200)
+
+def request_head_api_repo_charts_chart_version(_repo, _chart, _version):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    if _chart not in CACHE['index'][_repo]['records']:
+        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+
+    if _version not in CACHE['index'][_repo]['records'][_chart]:
+        return ('{{"error":"{repo}/{chart}-{version} not found"}}'.format(repo=_repo, chart=_chart, version=_version), 404)
+
+    return ('{}', 200)
+
+def request_get_api_repo_charts_chart_version(_repo, _chart, _version, _constraint=None, _prerelease=False):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    if _chart not in CACHE['index'][_repo]['records']:
+        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+
+    version=_version
+    if _version is None:
+        #latest matching version, latest stable without constraint
+        try:
+            versions=version_select(CACHE['index'][_repo], _chart, _constraint, 1, _prerelease)
+        except ValueError as e:
+            return (json.dumps({ 'error': str(e) }), 400)
+
+        if len(versions) == 0 and _constraint is None:
+            versions=version_select(CACHE['index'][_repo], _chart, None, 1, True)
+
+        if len(versions) == 0:
+            return ('{{"error":"{repo}/{chart} has no version matching {constraint}"}}'.format(repo=_repo, chart=_chart, constraint=_constraint), 404)
+
+        version=versions[0]
+    
+    if version not in CACHE['index'][_repo]['records'][_chart]:
+        return ('{{"error":"{repo}/{chart}-{version} not found"}}'.format(repo=_repo, chart=_chart, version=_version), 404)
+        
+    return record_fragment(_repo, CACHE['index'][_repo]['records'][_chart][version], 'json')
+
+def request_get_api_repo_charts_chart(_repo, _chart, _constraint=None, _top=None, _prerelease=False):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    if _chart not in CACHE['index'][_repo]['records']:
+        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+
+    cache=CACHE['index'][_repo]
+
+    if _constraint is None and _top is None:
+        return chart_render(_repo, _chart, cache_chart_records(cache, _chart), 'json')
+
+    top=_top
+    if top is None:
+        top=len(cache['versions'][_chart][0])
+
+    #without constraint top N includes prereleases, as the whole list does
+    prerelease=_prerelease or _constraint is None
+
+    try:
+        versions=version_select(cache, _chart, _constraint, max(top, 0), prerelease)
+    except ValueError as e:
+        return (json.dumps({ 'error': str(e) }), 400)
+
+    return '[{list}]'.format(
+        list=",".join(
+            record_fragment(_repo, cache['records'][_chart][v], 'json') for v in versions
+        )
+    )
+
+def request_get_api_repo_changes(_repo, _since):
+    if _repo not in CACHE['index']:
+        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+
+    try:
+        since=int(_since)
+    except (TypeError, ValueError):
+        return ('{"error":"since has to be an integer"}', 400)
+
+    #pending changes are published first, so events and generation
+    #match what index.yaml serves
+    cache_render_pending(_repo)
+
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        cache=CACHE['index'][_repo]
+        generation=cache['generation']
+        journal=cache['journal'] or []
+
+        #journal rolled past since, or since comes from before a restart
+        if since < cache['journal_start'] or since > generation:
+            return (
+                json.dumps({ 'generation': generation, 'resync': True }),
+                410
+            )
+
+        i=len(journal)
+        while i > 0 and journal[i-1][0] > since:
+            i=i-1
+
+        changes=[
+            {
+                'generation': e[0],
+                'op': e[1],
+                'chart': e[2],
+                'version': e[3],
+                'digest': e[4],
+                'created': e[5]
+            } for e in journal[i:]
+        ]
+    finally:
+        CACHE['mutexes'][_repo].release()
+
+    return json.dumps({ 'generation': generation, 'resync': False, 'changes': changes })
+
+def request_get_api_search(_q, _limit):
+    global CHARTHALL_PAGE_LIMIT
+
+    if _q is None or _q.strip() == '':
+        return ('{"error":"q is required"}', 400)
+
+    limit=_limit
+    if limit is None or limit > CHARTHALL_PAGE_LIMIT:
+        limit=CHARTHALL_PAGE_LIMIT
+
+    if limit < 1:
+        return ('{"error":"limit has to be positive"}', 400)
+
+    q=_q.strip().lower()
+
+    #exact names first, then names starting with q, then the rest
+    def rank(_entry):
+        name=_entry[1].lower()
+        if name == q:
+            return (0, name, _entry[0])
+        if name.startswith(q):
+            return (1, name, _entry[0])
+        return (2, name, _entry[0])
+
+    hits=[]
+    for r, c in sorted(search_find(q), key=rank):
+        if r not in CACHE['mutexes']:
+            continue
+
+        CACHE['mutexes'][r].acquire()
+        try:
+            cache=CACHE['index'][r]
+            versions=version_select(cache, c, None, 1)
+            if len(versions) == 0:
+                versions=version_select(cache, c, None, 1, True)
+        finally:
+            CACHE['mutexes'][r].release()
+
+        if len(versions) == 0:
+            continue
+
+        hits.append({ 'repo': r, 'chart': c, 'version': versions[0] })
+
+        if len(hits) >= limit:
+            break
+
+    return json.dumps(hits)
+
+def request_get_ready(_detail=True):
+    #names of repos are listed only to callers allowed to read them
+    ready=len(CACHE['pending']) == 0
+
+    status=200
+    if not ready:
+        status=503
+
+    if not _detail:
+        return (json.dumps({ 'ready': ready }), status)
+
+    repos={}
+
+    for r in list(CACHE['index']):
+        state='ready'
+        if r in CACHE['pending']:
+            state='queued'
+            if r in CACHE['rebuilding']:
+                state='indexing'
+
+        repos[r]={ 'state': state }
+
+        progress=CACHE['progress'].get(r)
+        if progress is not None and state != 'queued':
+            repos[r].update(progress)
+
+    return (json.dumps({ 'ready': ready, 'repos': repos }), status)
+
+def request_get_metrics():
+    counters={}
+    histograms={}
+
+    METRICS['lock'].acquire()
+    try:
+        shards=list(METRICS['shards'])
+    finally:
+        METRICS['lock'].release()
+
+    #shards are read without locking, a scrape may miss an update
+    #that is in progress, it shows up on the next one
+    for shard in shards:
+        for key, value in list(shard['counters'].items()):
+            counters[key]=counters.get(key, 0)+value
+
+        for key, h in list(shard['histograms'].items()):
+            if key not in histograms:
+                histograms[key]=[ h[0], [0]*len(h[1]), 0 ]
+
+            merged=histograms[key]
+            for i, c in enumerate(list(h[1])):
+                merged[1][i]+=c
+            merged[2]+=h[2]
+
+    gauges={}
+
+    seconds=counters.get(('charthall_digest_seconds_total', ()), 0)
+    if seconds > 0:
+        gauges[('charthall_digest_throughput_bytes_per_second', ())]= \
+            counters.get(('charthall_digest_bytes_total', ()), 0)/seconds
+
+    for r in list(CACHE['index']):
+        cache=CACHE['index'][r]
+        document=cache.get('document')
+
+        gauges[('charthall_index_charts', (('repo', r),))]=len(cache['records'])
+
+        if document is None:
+            continue
+
+        gauges[('charthall_index_generation', (('repo', r),))]=document['generation']
+
+        for kind in [ 'yaml', 'json' ]:
+            for encoding in document[kind]:
+                gauges[('charthall_index_document_bytes', (('repo', r), ('kind', kind), ('encoding', encoding)))]= \
+                    document[kind][encoding][1]
+
+    lines=[]
+    described=set()
+
+    def describe(_name):
+        if _name in described or _name not in METRICS_HELP:
+            return
+        described.add(_name)
+        lines.append('# HELP {name} {help}'.format(name=_name, help=METRICS_HELP[_name][1]))
+        lines.append('# TYPE {name} {type}'.format(name=_name, type=METRICS_HELP[_name][0]))
+
+    for name, labels in sorted(counters):
+        describe(name)
+        lines.append('{name}{labels} {value}'.format(
+            name=name,
+            labels=metrics_labels(labels),
+            value=counters[(name, labels)]
+        ))
+
+    for name, labels in sorted(gauges):
+        describe(name)
+        lines.append('{name}{labels} {value}'.format(
+            name=name,
+            labels=metrics_labels(labels),
+            value=gauges[(name, labels)]
+        ))
+
+    for name, labels in sorted(histograms):
+        describe(name)
+        buckets, counts, total=histograms[(name, labels)]
+
+        cumulative=0
+        for i, le in enumerate(list(buckets)+[ '+Inf' ]):
+            cumulative+=counts[i]
+            lines.append('{name}_bucket{labels} {value}'.format(
+                name=name,
+                labels=metrics_labels(labels+(('le', le),)),
+                value=cumulative
+            ))
+
+        lines.append('{name}_sum{labels} {value}'.format(name=name, labels=metrics_labels(labels), value=total))
+        lines.append('{name}_count{labels} {value}'.format(name=name, labels=metrics_labels(labels), value=cumulative))
+
+    return '\n'.join(lines)+'\n'
+
+def profile_frame(_frame):
+    code=_frame.f_code
+
+    return '{function} ({file}:{line})'.format(
+        function=code.co_name,
+        file=os.path.basename(code.co_filename),
+        line=code.co_firstlineno
+    )
+
+def profile_sample(_seconds, _interval):
+    #samples stacks of all other threads, returns { collapsed stack: samples }
+    stacks={}
+    names={}
+    me=threading.get_ident()
+
+    end=time.perf_counter()+_seconds
+    samples=0
+
+    while time.perf_counter() < end:
+        for t in threading.enumerate():
+            names[t.ident]=t.name
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack=[]
+            while frame is not None:
+                stack.append(profile_frame(frame))
+                frame=frame.f_back
+
+            stack.append(names.get(ident, 'thread-'+str(ident)))
+            key=';'.join(reversed(stack))
+
+            stacks[key]=stacks.get(key, 0)+1
+
+        samples=samples+1
+        time.sleep(_interval)
+
+    return (samples, stacks)
+
+def request_get_admin_profile(_seconds, _interval, _format):
+    global CHARTHALL_PROFILER_MAX_SECONDS
+
+    if not CHARTHALL_PROFILER or CHARTHALL_BASIC_AUTH_USER is None or CHARTHALL_BASIC_AUTH_PASS is None:
+        return ('{"error":"profiler requires PROFILER=true and basic authentication"}', 403, { 'Content-Type': 'application/json; charset=utf-8' })
+
+    seconds=min(max(_seconds or 10, 0.1), CHARTHALL_PROFILER_MAX_SECONDS)
+    interval=min(max(_interval or 0.01, 0.001), 1)
+
+    #one profile at a time, sampling is not free
+    if not PROFILER['lock'].acquire(blocking=False):
+        return ('{"error":"profile already running"}', 409, { 'Content-Type': 'application/json; charset=utf-8' })
+
+    try:
+        log_print('INFO', 'request_get_admin_profile(): sampling {seconds}s every {interval}s'.format(
+            seconds=seconds,
+            interval=interval
+        ))
+        samples, stacks=profile_sample(seconds, interval)
+    finally:
+        PROFILER['lock'].release()
+
+    if _format == 'json':
+        return (
+            json.dumps({
+                'seconds': seconds,
+                'interval': interval,
+                'samples': samples,
+                'stacks': stacks
+            }),
+            200,
+            { 'Content-Type': 'application/json; charset=utf-8' }
+        )
+
+    #collapsed stacks, input of flamegraph.pl, speedscope and similar
+    return (
+        ''.join(
+            '{stack} {count}\n'.format(stack=k, count=v)
+            for k, v in sorted(stacks.items(), key=lambda _i: -_i[1])
+        ),
+        200,
+        { 'Content-Type': 'text/plain; charset=utf-8' }
+    )
+
+################ ROUTES ################
+def auth_build():
+    global CHARTHALL_BASIC_AUTH_USER
+    global CHARTHALL_BASIC_AUTH_PASS
+    global CHARTHALL_AUTH_ANONYMOUS_GET
+
+    auth = HTTPBasicAuth()
+    
+    allow_anonymous_get=False
+    allow_anonymous_nonget=False
+
+    if CHARTHALL_BASIC_AUTH_USER is not None and CHARTHALL_BASIC_AUTH_PASS is not None:
+        allow_anonymous_nonget=False
+
+        if CHARTHALL_AUTH_ANONYMOUS_GET:
+            allow_anonymous_get=True
+    else:
+        allow_anonymous_get=True
+        allow_anonymous_nonget=True
+    
+    @auth.verify_password
+    def verify_password(_user, _password):
+        start=time.perf_counter()
+        try:
+            return verify_password_check(_user, _password)
+        finally:
+            timing_add('auth', time.perf_counter()-start)
+
+    def verify_password_check(_user, _password):
+        global CHARTHALL_BASIC_AUTH_USER
+        global CHARTHALL_BASIC_AUTH_PASS
+
+        if CHARTHALL_BASIC_AUTH_USER is None or CHARTHALL_BASIC_AUTH_PASS is None:
+            return 'anonymous'
+
+        if _user == CHARTHALL_BASIC_AUTH_USER and _password == CHARTHALL_BASIC_AUTH_PASS:
+            return _user
+            
+        return None
+
+    return (auth, allow_anonymous_get, allow_anonymous_nonget)
+
+def app_build():
+
+    global app
+    global auth
+
+    app = Flask(__name__)
+    RequestID(app)
+
+    auth, allow_anonymous_get, allow_anonymous_nonget=auth_build()
+
+    @app.before_request
+    def metrics_start():
+        g.metrics_start=time.perf_counter()
+
+        TIMING.phases=None
+        if CHARTHALL_SERVER_TIMING:
+            TIMING.phases={}
+
+    @app.after_request
+    def metrics_finish(_response):
+        route='unmatched'
+        if request.url_rule is not None:
+            route=request.url_rule.rule
+
+        metrics_observe(
+            'charthall_http_request_duration_seconds',
+            (('route', route), ('method', request.method), ('status', _response.status_code)),
+            time.perf_counter()-g.metrics_start
+        )
+
+        metrics_observe(
+            'charthall_http_response_size_bytes',
+            (('route', route),),
+            _response.content_length or 0,
+            METRICS_BUCKETS_BYTES
+        )
+
+        if TIMING.phases is not None:
+            _response.headers['Server-Timing']=timing_header(TIMING.phases, time.perf_counter()-g.metrics_start)
+            TIMING.phases=None
+
+        return _response
+
+    def authorized(_anonymous):
+        #same decision as login_required of the view, before it runs
+        if _anonymous:
+            return True
+
+        authorization=request.authorization
+        if authorization is None:
+            return False
+
+        return auth.verify_password_callback(
+            authorization.username,
+            authorization.password
+        ) is not None
+
+    #repo which is not indexed yet is not served with partial content
+    @app.before_request
+    def repo_ready():
+        if request.view_args is None or '_repo' not in request.view_args:
+            return
+
+        if request.method == 'POST' or request.endpoint == 'route_repo_charts_file':
+            return
+
+        #unauthorized request gets 401 from the view, without waiting
+        #and without moving the repo ahead of the others
+        anonymous=allow_anonymous_get
+        if request.method not in [ 'GET', 'HEAD' ]:
+            anonymous=allow_anonymous_nonget
+
+        if not authorized(anonymous):
+            return
+
+        if not repo_wait_ready(request.view_args['_repo']):
+            return ('{"error":"repo is being indexed"}', 503, {
+                'Content-Type': 'application/json; charset=utf-8',
+                'Retry-After': '1'
+            })
+
+    #follower gets all changes from the leader
+    @app.before_request
+    def follower_read_only():
+        if CHARTHALL_FOLLOW_LEADER is not None and request.method not in [ 'GET', 'HEAD' ]:
+            return '{"error": "read only follower"}', 403, { 'Content-Type': 'application/json; charset=utf-8' }
+
+    #GET /health
+    @app.route('/health')
+    def route_get_health():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        return '{"healthy":true}'
+
+    #GET /api/search
+    @app.route('/api/search', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_search():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        return request_get_api_search(
+            request.args.get('q'),
+            request.args.get('limit', type=int)
+        )
+
+    #GET /ready
+    @app.route('/ready')
+    def route_get_ready():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        return request_get_ready(authorized(allow_anonymous_get))
+
+    #GET /metrics
+    @app.route('/metrics')
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_get_metrics():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='text/plain; version=0.0.4; charset=utf-8'
+            return _response
+
+        return request_get_metrics()
+
+    #GET /admin/profile
+    @app.route('/admin/profile')
+    @auth.login_required
+    def route_get_admin_profile():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            return _response
+
+        return request_get_admin_profile(
+            request.args.get('seconds', type=float),
+            request.args.get('interval', type=float),
+            request.args.get('format', 'collapsed')
+        )
+
+    #GET /    
+    @app.route('/')
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_get_repos():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/x-yaml'
+            return _response
+    
+        return CACHE['repos']
+    
+    #GET /info
+    @app.route('/info')
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_get_info():
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        return CACHE['info']
+
+    #GET /index.yaml
+    @app.route('/<_repo>/index.yaml', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_repo_index_yaml(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/x-yaml'
+            return _response
+        
+        if _repo not in CACHE['index']:
+
+            now_generated=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+            return ("""apiVersion: v1
+entries: {{}}
+generated: "{generated}"
+serverInfo: {{}}
+""".format(
+            generated=now_generated
+        ), 200)
+
+        cache_render_pending(_repo)
+
+        return response_encoded(CACHE['index'][_repo], 'yaml')
+
+    #GET /charts/<_file>
+    @app.route('/<_repo>/charts/<_file>', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_repo_charts_file(_repo,_file):
+        @after_this_request
+        def add_header(_response):            
+            _response.headers['X-Request-Id'] = current_request_id()            
+            return _response
+
+        return request_get_repo_charts_file(_repo, _file)
+
+    @app.route('/api/<_repo>/charts', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_repo_charts(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'GET':
+            if not any(a in request.args for a in [ 'limit', 'cursor', 'prefix', 'q' ]):
+                return request_get_api_repo_charts(_repo)
+
+            return request_get_api_repo_charts_page(
+                _repo,
+                request.args.get('limit', type=int),
+                request.args.get('cursor'),
+                request.args.get('prefix'),
+                request.args.get('q')
+            )
+
+        return ( '{"error":"unknown method"}', 400 )
+
+    #POST /api/charts
+    @app.route('/api/<_repo>/charts', methods=['POST'])
+    @auth.login_required(optional=allow_anonymous_nonget)
+    def route_POST_api_repo_charts(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'POST':
+            req_chart=None
+            if CHARTHALL_CHART_POST_FORM_FIELD_NAME in request.files:
+                req_chart=request.files[CHARTHALL_CHART_POST_FORM_FIELD_NAME]
+
+            req_prov=None
+            if CHARTHALL_PROV_POST_FORM_FIELD_NAME in request.files:
+                req_prov=request.files[CHARTHALL_PROV_POST_FORM_FIELD_NAME]
+
+            return request_post_api_repo_charts(_repo, req_chart, req_prov)
+
+        return ( '{"error":"unknown method"}', 400 )
+
+    #POST /api/prov
+    @app.route('/api/<_repo>/post', methods=['POST'])
+    @auth.login_required(optional=allow_anonymous_nonget)
+    def route_POST_api_repo_prov(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'POST':
+            req_prov=None
+            if CHARTHALL_PROV_POST_FORM_FIELD_NAME in request.files:
+                req_prov=request.files[CHARTHALL_PROV_POST_FORM_FIELD_NAME]
+
+            return request_post_api_repo_prov(_repo, req_prov)
+
+        return ( '{"error":"unknown method"}', 400 )
+
+    #POST /api/bulk
+    @app.route('/api/<_repo>/bulk', methods=['POST'])
+    @auth.login_required(optional=allow_anonymous_nonget)
+    def route_POST_api_repo_bulk(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'POST':
+            if request.mimetype == 'multipart/form-data':
+                return request_post_api_repo_bulk(_repo, put_files_multipart(request.files))
+
+            return request_post_api_repo_bulk(_repo, put_files_tar(request.stream))
+
+        return ( '{"error":"unknown method"}', 400 )
+
+    #DELETE /api/bulk
+    @app.route('/api/<_repo>/bulk', methods=['DELETE'])
+    @auth.login_required(optional=allow_anonymous_nonget)
+    def route_DELETE_api_repo_bulk(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'DELETE':
+            return request_delete_api_repo_bulk(_repo, request.get_json(force=True, silent=True))
+
+        return ( '{"error":"unknown method"}', 400 )
+
+    #GET /api/changes
+    @app.route('/api/<_repo>/changes', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_repo_changes(_repo):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        return request_get_api_repo_changes(_repo, request.args.get('since'))
+
+    #GET /api/charts/<_chart>
+    @app.route('/api/<_repo>/charts/<_chart>', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_repo_charts_chart(_repo,_chart):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='application/json; charset=utf-8'
+            return _response
+
+        if request.method == 'GET':
+            return request_get_api_repo_charts_chart(
+                _repo,
+                _chart,
+                request.args.get('constraint'),
+                request.args.get('top', type=int),
+                request.args.get('devel', 'false').lower() == 'true'
+            )
 
-def request_head_api_repo_charts_chart(_repo, _chart):
-    if _repo not in CACHE['index']:
-        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+        if request.method == 'HEAD':
+            return request_head_api_repo_charts_chart(_repo, _chart)
 
-    if _chart not in CACHE['index'][_repo]['json_chart_version']:
-        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+        return ( '{"error":"unknown method"}', 400 )
 
-    return ('{}', 200)
+    #GET /api/charts/<_chart>/
+    #GET /api/charts/<chart>/<version>
+    @app.route('/api/<_repo>/charts/<_chart>/', methods=['GET', 'HEAD'], defaults={'_version': None})
+    @app.route("/api/<_repo>/charts/<_chart>/<_version>", methods=['GET', 'HEAD'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_repo_charts_chart_version(_repo, _chart, _version):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='text/x-yaml; charset=utf-8'
+            return _response
+        
+        if request.method == 'HEAD':
+            if _version is None:
+                return request_head_api_repo_charts_chart(_repo, _chart)
 
-def request_head_api_repo_charts_chart_version(_repo, _chart, _version):
-    if _repo not in CACHE['index']:
-        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+            return request_head_api_repo_charts_chart_version(_repo, _chart, _version)
 
-    if _chart not in CACHE['index'][_repo]['json_chart_version']:
-        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+        if request.method == 'GET':
+            return request_get_api_repo_charts_chart_version(
+                _repo,
+                _chart,
+                _version,
+                request.args.get('constraint'),
+                request.args.get('devel', 'false').lower() == 'true'
+            )
 
-    if _version not in CACHE['index'][_repo]['json_chart_version'][_chart]:
-        return ('{{"error":"{repo}/{chart}-{version} not found"}}'.format(repo=_repo, chart=_chart, version=_version), 404)
+        return ( '{"error":"unknown method"}', 400 )
 
-    return ('{}', 200)
+    #DELETE /api/charts/<chart>/<version>
+    @app.route("/api/<_repo>/charts/<_chart>/<_version>", methods=['DELETE'])
+    @auth.login_required(optional=allow_anonymous_nonget)
+    def route_DELETE_api_repo_charts_chart_version(_repo, _chart, _version):
+        @after_this_request
+        def add_header(_response):
+            _response.headers['X-Request-Id'] = current_request_id()
+            _response.headers['Content-Type']='text/x-yaml; charset=utf-8'
+            return _response
 
-def request_get_api_repo_charts_chart_version(_repo, _chart, _version):
-    if _repo not in CACHE['index']:
-        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+        if request.method == 'DELETE':
+            return request_delete_api_repo_charts_chart_version(_repo, _chart, _version)
+                
+        return ( '{"error":"unknown method"}', 400 )
 
-    if _chart not in CACHE['index'][_repo]['json_chart_version']:
-        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
+    return app
 
-    version=_version
-    if _version is None:
-        version=list(CACHE['index'][_repo]['json_chart_version'][_chart].keys())[0]
-    
-    if version not in CACHE['index'][_repo]['json_chart_version'][_chart]:
-        return ('{{"error":"{repo}/{chart}-{version} not found"}}'.format(repo=_repo, chart=_chart, version=_version), 404)
-        
-    return CACHE['index'][_repo]['json_chart_version'][_chart][version]
+################ WORKERS ################
+READER={
+    'shared': {}
+}
 
-def request_get_api_repo_charts_chart(_repo, _chart):
-    if _repo not in CACHE['index']:
-        return ('{{"error":"{repo} not found"}}'.format(repo=_repo), 404)
+HOP_BY_HOP=[
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'
+]
 
-    if _chart not in CACHE['index'][_repo]['json_chart_version']:
-        return ('{{"error":"{repo}/{chart} not found"}}'.format(repo=_repo, chart=_chart), 404)
-    
-    return CACHE['index'][_repo]['json_chart'][_chart]
+class UnixHTTPConnection(http.client.HTTPConnection):
 
-################ ROUTES ################
-def app_build():
+    def __init__(self, _path, timeout=300):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.unix_path=_path
 
-    global app
-    global auth
+    def connect(self):
+        self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
 
-    app = Flask(__name__)
-    RequestID(app)
-    auth = HTTPBasicAuth()
+def shared_open(_repo):
+    #mapping is replaced when writer renamed a new document in place,
+    #responses still being sent keep the old one alive
+    file_path=shared_path(_repo, '.doc')
 
-    global CHARTHALL_BASIC_AUTH_USER
-    global CHARTHALL_BASIC_AUTH_PASS
-    global CHARTHALL_AUTH_ANONYMOUS_GET
-    
-    allow_anonymous_get=False
-    allow_anonymous_nonget=False
+    try:
+        st=os.stat(file_path)
+    except FileNotFoundError:
+        return None
 
-    if CHARTHALL_BASIC_AUTH_USER is not None and CHARTHALL_BASIC_AUTH_PASS is not None:
-        allow_anonymous_nonget=False
+    key=(st.st_ino, st.st_size, st.st_mtime_ns)
 
-        if CHARTHALL_AUTH_ANONYMOUS_GET:
-            allow_anonymous_get=True
-    else:
-        allow_anonymous_get=True
-        allow_anonymous_nonget=True
-    
-    @auth.verify_password
-    def verify_password(_user, _password):
-        global CHARTHALL_BASIC_AUTH_USER
-        global CHARTHALL_BASIC_AUTH_PASS
+    cached=READER['shared'].get(_repo)
+    if cached is not None and cached[0] == key:
+        return cached[1]
 
-        if CHARTHALL_BASIC_AUTH_USER is None or CHARTHALL_BASIC_AUTH_PASS is None:
-            return 'anonymous'
+    with open(file_path, 'rb') as f:
+        mm=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        if _user == CHARTHALL_BASIC_AUTH_USER and _password == CHARTHALL_BASIC_AUTH_PASS:
-            return _user
-            
+    start=len(CHARTHALL_SHARED_MAGIC)
+    if mm[:start] != CHARTHALL_SHARED_MAGIC:
         return None
 
-    #GET /health
-    @app.route('/health')
-    def route_get_health():
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
-            return _response
+    header_length=struct.unpack_from('<I', mm, start)[0]
+    start=start+4
+    header=json.loads(mm[start:start+header_length])
+    start=start+header_length
 
-        return '{"healthy":true}'
+    for kind in [ 'yaml', 'json' ]:
+        for encoding in header[kind]:
+            header[kind][encoding][0]=header[kind][encoding][0]+start
 
-    #GET /    
-    @app.route('/')
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_get_repos():
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/x-yaml'
-            return _response
-    
-        return CACHE['repos']
-    
-    #GET /info
-    @app.route('/info')
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_get_info():
+    READER['shared'][_repo]=(key, (mm, header))
+
+    return (mm, header)
+
+def response_shared(_shared, _kind):
+    mm, header=_shared
+    document=header[_kind]
+
+    encoding=request.accept_encodings.best_match(
+        [ e for e in CHARTHALL_ENCODINGS if e in document ],
+        default='identity'
+    )
+
+    headers={
+        'Vary': 'Accept-Encoding',
+        'X-Charthall-Generation': str(header['generation']),
+        'ETag': '"{etag}-{encoding}"'.format(
+            etag=header['etag'][_kind],
+            encoding=encoding
+        )
+    }
+
+    if request.if_none_match.contains_weak(headers['ETag'][1:-1]):
+        return ('', 304, headers)
+
+    offset, length=document[encoding]
+
+    if encoding != 'identity':
+        headers['Content-Encoding']=encoding
+
+    headers['Content-Length']=str(length)
+
+    def body():
+        #slices of the mapping, document is never copied into python
+        with memoryview(mm) as mv:
+            for i in range(offset, offset+length, CHARTHALL_SHARED_CHUNK):
+                yield mv[i:min(i+CHARTHALL_SHARED_CHUNK, offset+length)]
+
+    return Response(body(), 200, headers)
+
+def proxy_to_writer():
+    headers={}
+    for k, v in request.headers:
+        if k.lower() not in HOP_BY_HOP:
+            headers[k]=v
+
+    body=None
+    if request.content_length:
+        body=request.stream
+    elif request.method in [ 'POST', 'PUT', 'PATCH', 'DELETE' ]:
+        body=request.get_data()
+        headers['Content-Length']=str(len(body))
+
+    url=urllib.parse.quote(request.script_root+request.path)
+    if len(request.query_string) > 0:
+        url=url+'?'+request.query_string.decode('latin-1')
+
+    try:
+        connection=UnixHTTPConnection(CHARTHALL_WRITER_SOCKET)
+        connection.request(request.method, url, body=body, headers=headers)
+        response=connection.getresponse()
+    except Exception as e:
+        log_print(
+            'ERROR', 'proxy_to_writer({url}): {msg}'.format(
+                url=url,
+                msg=str(e)
+            )
+        )
+        return ('{"error":"writer not available"}', 503, { 'Content-Type': 'application/json; charset=utf-8' })
+
+    def body_iter():
+        try:
+            while True:
+                data=response.read(CHARTHALL_SHARED_CHUNK)
+                if not data:
+                    break
+                yield data
+        finally:
+            connection.close()
+
+    return Response(
+        body_iter(),
+        response.status,
+        [ (k, v) for k, v in response.getheaders() if k.lower() not in HOP_BY_HOP ]
+    )
+
+def reader_app_build():
+    #read worker, serves index documents published by the writer and chart
+    #files from storage, everything else is forwarded to the writer
+
+    app = Flask(__name__)
+    RequestID(app)
+
+    auth, allow_anonymous_get, allow_anonymous_nonget=auth_build()
+
+    def route_shared(_repo, _kind):
         @after_this_request
         def add_header(_response):
             _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
             return _response
 
-        return CACHE['info']
+        shared=None
+        if repo_name_valid(_repo) and not os.path.exists(shared_path(_repo, '.dirty')):
+            shared=shared_open(_repo)
+
+        if shared is None:
+            return proxy_to_writer()
+
+        response=response_shared(shared, _kind)
+
+        if _kind == 'yaml':
+            content_type='application/x-yaml'
+        else:
+            content_type='application/json; charset=utf-8'
+
+        if isinstance(response, Response):
+            response.headers['Content-Type']=content_type
+
+        return response
 
     #GET /index.yaml
     @app.route('/<_repo>/index.yaml', methods=['GET'])
     @auth.login_required(optional=allow_anonymous_get)
     def route_repo_index_yaml(_repo):
+        return route_shared(_repo, 'yaml')
+
+    #GET /api/charts
+    @app.route('/api/<_repo>/charts', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_api_repo_charts(_repo):
+        #pages come from the index of chart names kept by the writer
+        if any(a in request.args for a in [ 'limit', 'cursor', 'prefix', 'q' ]):
+            return proxy_to_writer()
+
+        return route_shared(_repo, 'json')
+
+    #GET /charts/<_file>
+    @app.route('/<_repo>/charts/<_file>', methods=['GET'])
+    @auth.login_required(optional=allow_anonymous_get)
+    def route_repo_charts_file(_repo,_file):
         @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/x-yaml'
+        def add_header(_response):            
+            _response.headers['X-Request-Id'] = current_request_id()            
             return _response
+
+        #same etag as the writer, digest comes with the published document
+        etag=None
+        if repo_name_valid(_repo):
+            shared=shared_open(_repo)
+            if shared is not None:
+                etag=shared[1]['files'].get(_file)
+
+        return request_get_repo_charts_file(_repo, _file, etag)
+
+    #anything else is handled by the writer, including authentication
+    @app.route('/', defaults={'_path': ''}, methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    @app.route('/<path:_path>', methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    def route_writer(_path):
+        return proxy_to_writer()
+
+    return app
+
+def rebuild_cache_on_timer():
+
+    sleep_time=0
+
+    try:
+        sleep_time=int(CHARTHALL_CACHE_INTERVAL.replace('m',''))*60
+    except:
+        log_print('WARNING', 'CACHE_INTERVAL not set or not an integer, assuming no CACHE_REBUILD')
+        pass
+
         
-        if _repo not in CACHE['index']:
+    while sleep_time>0:
+        time.sleep(sleep_time)
+        cache_rebuild()
+
+def inotify_init():
+    try:
+        libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+        fd=libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        return (libc, fd)
+
+    except Exception as e:
+        log_print(
+            'WARNING', 'inotify not available, falling back to polling every {poll}s: {msg}'.format(
+                poll=CHARTHALL_WATCH_POLL,
+                msg=str(e)
+            )
+        )
+        return None
+
+def inotify_add_watch(_inotify, _watches, _repo):
+    libc, fd=_inotify
+
+    if _repo == '':
+        path=CHARTHALL_STORAGE_LOCAL_ROOTDIR
+        mask=INOTIFY['IN_CREATE'] | INOTIFY['IN_MOVED_TO']
+    else:
+        path=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo)
+        mask=INOTIFY['IN_CLOSE_WRITE'] | INOTIFY['IN_MOVED_TO'] \
+            | INOTIFY['IN_MOVED_FROM'] | INOTIFY['IN_DELETE']
+
+    wd=libc.inotify_add_watch(fd, os.fsencode(path), mask)
+    if wd < 0:
+        log_print(
+            'WARNING', 'inotify_add_watch({path}): errno {errno}'.format(
+                path=path,
+                errno=ctypes.get_errno()
+            )
+        )
+        return
+
+    _watches[wd]=_repo
+
+def watch_apply(_repo, _filename):
+    try:
+        if _filename is not None:
+            cache_apply_file(_repo, _filename)
+            return
+
+        #new repo directory, index all of it
+        cache_add_repo(_repo)
+        cache_rebuild_repo_charts(_repo)
+
+    except Exception as e:
+        log_print(
+            'ERROR', 'watch_apply({repo}, {file}): {msg}'.format(
+                repo=_repo,
+                file=_filename,
+                msg=str(e)
+            )
+        )
+
+def watch_inotify(_inotify):
+    global CHARTHALL_WATCH_DELAY
+
+    libc, fd=_inotify
+
+    watches={}
+    inotify_add_watch(_inotify, watches, '')
+    for r in os.listdir(CHARTHALL_STORAGE_LOCAL_ROOTDIR):
+        if repo_name_valid(r) and os.path.isdir(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, r)):
+            inotify_add_watch(_inotify, watches, r)
+
+    #(repo, filename) -> time of the last event, files are applied only
+    #after they were quiet for WATCH_DELAY, so partially written files
+    #are not indexed
+    pending={}
+
+    while True:
+        timeout=None
+        if len(pending) > 0:
+            timeout=max(0, min(pending.values())+CHARTHALL_WATCH_DELAY-time.time())
+
+        readable, _, _=select.select([fd], [], [], timeout)
+
+        if readable:
+            buffer=os.read(fd, 64*1024)
+            offset=0
+
+            while offset < len(buffer):
+                wd, mask, cookie, length=struct.unpack_from('iIII', buffer, offset)
+                name=os.fsdecode(buffer[offset+16:offset+16+length].rstrip(b'\0'))
+                offset=offset+16+length
+
+                if mask & INOTIFY['IN_Q_OVERFLOW']:
+                    log_print('WARNING', 'inotify queue overflow, rebuilding cache')
+                    pending={}
+                    cache_rebuild()
+                    continue
+
+                if mask & INOTIFY['IN_IGNORED']:
+                    watches.pop(wd, None)
+                    continue
+
+                if wd not in watches:
+                    continue
+
+                repo=watches[wd]
+
+                if repo == '':
+                    if mask & INOTIFY['IN_ISDIR'] and repo_name_valid(name):
+                        inotify_add_watch(_inotify, watches, name)
+                        pending[(name, None)]=time.time()
+                    continue
+
+                if name.endswith('.tgz'):
+                    pending[(repo, name)]=time.time()
+
+        now=time.time()
+        for key in [ k for k in pending if pending[k]+CHARTHALL_WATCH_DELAY <= now ]:
+            del pending[key]
+            watch_apply(key[0], key[1])
+
+def watch_filesystem():
+    global CHARTHALL_WATCH_POLL
+
+    inotify=inotify_init()
+
+    if inotify is not None:
+        log_print('INFO', 'Watching '+CHARTHALL_STORAGE_LOCAL_ROOTDIR+' with inotify')
+        watch_inotify(inotify)
+        return
+
+    while True:
+        time.sleep(CHARTHALL_WATCH_POLL)
+        cache_rebuild()
+
+################ FOLLOWER ################
+FOLLOW={
+    'etag': {},
+    'generation': {}
+}
+
+def follow_request(_path, _headers=None):
+    #304 is returned as a response like 200, other errors are raised
+    headers={}
+    if _headers is not None:
+        headers.update(_headers)
+
+    if CHARTHALL_FOLLOW_USER is not None:
+        headers['Authorization']='Basic '+base64.b64encode(
+            '{user}:{password}'.format(
+                user=CHARTHALL_FOLLOW_USER,
+                password=CHARTHALL_FOLLOW_PASS or ''
+            ).encode('utf-8')
+        ).decode('ascii')
+
+    req=urllib.request.Request(CHARTHALL_FOLLOW_LEADER+_path, headers=headers)
+
+    try:
+        return urllib.request.urlopen(req, timeout=CHARTHALL_FOLLOW_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return e
+        raise
 
-            now_generated=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
+def follow_repos():
+    repos=[]
 
-            return ("""apiVersion: v1
-entries: {{}}
-generated: "{generated}"
-serverInfo: {{}}
-""".format(
-            generated=now_generated
-        ), 200)
+    with follow_request('/') as response:
+        for line in response.read().decode('utf-8').splitlines():
+            if line.startswith('- '):
+                repos.append(line[2:].strip())
 
-        return CACHE['index'][_repo]['yaml']
+    return repos
 
-    #GET /charts/<_file>
-    @app.route('/<_repo>/charts/<_file>', methods=['GET'])
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_repo_charts_file(_repo,_file):
-        @after_this_request
-        def add_header(_response):            
-            _response.headers['X-Request-Id'] = current_request_id()            
-            return _response
+def follow_created_ns(_created):
+    #created as rendered by cache_render_chart_version(), so that follower
+    #renders exactly the same timestamp as the leader
+    try:
+        dt=datetime.datetime.strptime(
+            _created[:26],
+            '%Y-%m-%dT%H:%M:%S.%f'
+        ).replace(tzinfo=datetime.timezone.utc)
 
-        return request_get_repo_charts_file(_repo, _file)
+        return int(dt.replace(microsecond=0).timestamp())*1000000000+dt.microsecond*1000
+    except Exception:
+        return None
 
-    @app.route('/api/<_repo>/charts', methods=['GET'])
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_api_repo_charts(_repo):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
-            return _response
+def follow_download(_repo, _filename, _digest=None, _created_ns=None):
+    file_path=os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _filename)
 
-        if request.method == 'GET':
-            return request_get_api_repo_charts(_repo)
+    with follow_request('/{repo}/charts/{file}'.format(
+            repo=urllib.parse.quote(_repo),
+            file=urllib.parse.quote(_filename)
+        )) as response:
 
-        return ( '{"error":"unknown method"}', 400 )
+        return storage_write(file_path, response, _digest, _created_ns)
 
-    #POST /api/charts
-    @app.route('/api/<_repo>/charts', methods=['POST'])
-    @auth.login_required(optional=allow_anonymous_nonget)
-    def route_POST_api_repo_charts(_repo):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
-            return _response
+def follow_fetch(_repo, _filename, _digest, _created):
+    follow_download(_repo, _filename, _digest, follow_created_ns(_created))
 
-        if request.method == 'POST':
-            req_chart=None
-            if CHARTHALL_CHART_POST_FORM_FIELD_NAME in request.files:
-                req_chart=request.files[CHARTHALL_CHART_POST_FORM_FIELD_NAME]
+    #leader does not publish digests of prov files nor which charts have
+    #one, missing prov is a plain 404 there
+    try:
+        follow_download(_repo, _filename+'.prov')
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        try:
+            os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _filename+'.prov'))
+        except FileNotFoundError:
+            pass
 
-            req_prov=None
-            if CHARTHALL_PROV_POST_FORM_FIELD_NAME in request.files:
-                req_prov=request.files[CHARTHALL_PROV_POST_FORM_FIELD_NAME]
+    #digest is already verified, cache_apply_file() finds it in ledger
+    st=os.stat(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, _filename))
 
-            return request_post_api_repo_charts(_repo, req_chart, req_prov)
+    CACHE['mutexes'][_repo].acquire()
+    try:
+        if _repo not in CACHE['ledger']:
+            CACHE['ledger'][_repo]=ledger_load(_repo)
 
-        return ( '{"error":"unknown method"}', 400 )
+        CACHE['ledger'][_repo][_filename]=ledger_entry(st, _digest)
+        CACHE['ledger_dirty'].add(_repo)
+    finally:
+        CACHE['mutexes'][_repo].release()
 
-    #POST /api/prov
-    @app.route('/api/<_repo>/post', methods=['POST'])
-    @auth.login_required(optional=allow_anonymous_nonget)
-    def route_POST_api_repo_prov(_repo):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
-            return _response
+    cache_apply_file(_repo, _filename)
 
-        if request.method == 'POST':
-            req_prov=None
-            if CHARTHALL_PROV_POST_FORM_FIELD_NAME in request.files:
-                req_prov=request.files[CHARTHALL_PROV_POST_FORM_FIELD_NAME]
+def follow_remove(_repo, _filename):
+    for f in [ _filename, _filename+'.prov' ]:
+        try:
+            os.remove(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, f))
+        except FileNotFoundError:
+            pass
 
-            return request_post_api_repo_prov(_repo, req_prov)
+    cache_apply_file(_repo, _filename)
 
-        return ( '{"error":"unknown method"}', 400 )
+def follow_apply(_repo, _remote, _removed):
+    # _remote: { filename: [ digest, created ] } to be in place,
+    # _removed: filenames to be removed, returns number of failures
+    if _repo not in CACHE['ledger']:
+        CACHE['ledger'][_repo]=ledger_load(_repo)
 
-    #GET /api/charts/<_chart>
-    @app.route('/api/<_repo>/charts/<_chart>', methods=['GET'])
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_api_repo_charts_chart(_repo,_chart):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='application/json; charset=utf-8'
-            return _response
+    local=dict(CACHE['ledger'][_repo])
 
-        if request.method == 'GET':
-            return request_get_api_repo_charts_chart(_repo,_chart)
+    failed=0
+    fetched=0
 
-        if request.method == 'HEAD':
-            return request_head_api_repo_charts_chart(_repo, _chart)
+    for f in _remote:
+        digest, created=_remote[f]
 
-        return ( '{"error":"unknown method"}', 400 )
+        entry=local.get(f)
+        if entry is not None and entry[3] == digest \
+            and os.path.exists(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo, f)):
+            continue
 
-    #GET /api/charts/<_chart>/
-    #GET /api/charts/<chart>/<version>
-    @app.route('/api/<_repo>/charts/<_chart>/', methods=['GET', 'HEAD'], defaults={'_version': None})
-    @app.route("/api/<_repo>/charts/<_chart>/<_version>", methods=['GET', 'HEAD'])
-    @auth.login_required(optional=allow_anonymous_get)
-    def route_api_repo_charts_chart_version(_repo, _chart, _version):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='text/x-yaml; charset=utf-8'
-            return _response
-        
-        if request.method == 'HEAD':
-            if _version is None:
-                return request_head_api_repo_charts_chart(_repo, _chart)
+        try:
+            follow_fetch(_repo, f, digest, created)
+            fetched=fetched+1
+        except Exception as e:
+            failed=failed+1
+            log_print(
+                'ERROR', 'follow_apply({repo}): {file}: {msg}'.format(
+                    repo=_repo,
+                    file=f,
+                    msg=str(e)
+                )
+            )
 
-            return request_head_api_repo_charts_chart_version(_repo, _chart, _version)
+    for f in _removed:
+        follow_remove(_repo, f)
 
-        if request.method == 'GET':
-            return request_get_api_repo_charts_chart_version(_repo, _chart, _version)
+    if fetched > 0 or len(_removed) > 0:
+        log_print(
+            'INFO', 'follow_apply({repo}): {fetched} fetched, {removed} removed, {failed} failed'.format(
+                repo=_repo,
+                fetched=fetched,
+                removed=len(_removed),
+                failed=failed
+            )
+        )
 
-        return ( '{"error":"unknown method"}', 400 )
+    return failed
 
-    #DELETE /api/charts/<chart>/<version>
-    @app.route("/api/<_repo>/charts/<_chart>/<_version>", methods=['DELETE'])
-    @auth.login_required(optional=allow_anonymous_nonget)
-    def route_DELETE_api_repo_charts_chart_version(_repo, _chart, _version):
-        @after_this_request
-        def add_header(_response):
-            _response.headers['X-Request-Id'] = current_request_id()
-            _response.headers['Content-Type']='text/x-yaml; charset=utf-8'
-            return _response
+def follow_repo_full(_repo):
+    headers={}
+    if _repo in FOLLOW['etag']:
+        headers['If-None-Match']=FOLLOW['etag'][_repo]
 
-        if request.method == 'DELETE':
-            return request_delete_api_repo_charts_chart_version(_repo, _chart, _version)
-                
-        return ( '{"error":"unknown method"}', 400 )
+    with follow_request('/api/{repo}/charts'.format(repo=urllib.parse.quote(_repo)), headers) as response:
+        if response.status == 304:
+            return
 
-    return app
+        etag=response.headers.get('ETag')
+        generation=response.headers.get('X-Charthall-Generation')
+        charts=json.load(response)
 
-def rebuild_cache_on_timer():
+    remote={}
+    for c in charts:
+        for v in charts[c]:
+            remote[ os.path.basename(urllib.parse.urlparse(v['urls'][0]).path) ]=[ v['digest'], v.get('created') ]
 
-    sleep_time=0
+    os.makedirs(os.path.join(CHARTHALL_STORAGE_LOCAL_ROOTDIR, _repo), exist_ok=True)
+    cache_add_repo(_repo)
 
-    try:
-        sleep_time=int(CHARTHALL_CACHE_INTERVAL.replace('m',''))*60
-    except:
-        log_print('WARNING', 'CACHE_INTERVAL not set or not an integer, assuming no CACHE_REBUILD')
-        pass
+    if _repo not in CACHE['ledger']:
+        CACHE['ledger'][_repo]=ledger_load(_repo)
 
-        
-    while sleep_time>0:
-        time.sleep(sleep_time)
-        cache_rebuild()
+    removed=[ f for f in CACHE['ledger'][_repo] if f not in remote ]
 
-def create_app(
+    #repo is checked again on the next round until everything is in place
+    if follow_apply(_repo, remote, removed) > 0:
+        return
+
+    if etag is not None:
+        FOLLOW['etag'][_repo]=etag
+
+    if generation is not None:
+        FOLLOW['generation'][_repo]=int(generation)
+
+def follow_repo(_repo):
+    #changes since the last generation seen, full list of charts when
+    #leader does not know the generation any more
+    if _repo in FOLLOW['generation']:
+        try:
+            with follow_request('/api/{repo}/changes?since={since}'.format(
+                    repo=urllib.parse.quote(_repo),
+                    since=FOLLOW['generation'][_repo]
+                )) as response:
+                feed=json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code not in [ 404, 410 ]:
+                raise
+            feed=None
+
+        if feed is not None:
+            #only the last event of a file matters
+            remote={}
+            removed=[]
+            for e in feed['changes']:
+                f=e['chart']+'-'+e['version']+'.tgz'
+
+                remote.pop(f, None)
+                if f in removed:
+                    removed.remove(f)
+
+                if e['op'] == 'delete':
+                    removed.append(f)
+                else:
+                    remote[f]=[ e['digest'], e['created'] ]
+
+            if follow_apply(_repo, remote, removed) == 0:
+                FOLLOW['generation'][_repo]=feed['generation']
+            return
+
+        del FOLLOW['generation'][_repo]
+
+    follow_repo_full(_repo)
+
+def follow_leader():
+    global CHARTHALL_FOLLOW_INTERVAL
+
+    while True:
+        try:
+            for r in follow_repos():
+                if not repo_name_valid(r):
+                    continue
+
+                try:
+                    follow_repo(r)
+                except Exception as e:
+                    log_print(
+                        'ERROR', 'follow_leader({repo}): {msg}'.format(
+                            repo=r,
+                            msg=str(e)
+                        )
+                    )
+        except Exception as e:
+            log_print(
+                'ERROR', 'follow_leader({leader}): {msg}'.format(
+                    leader=CHARTHALL_FOLLOW_LEADER,
+                    msg=str(e)
+                )
+            )
+
+        time.sleep(CHARTHALL_FOLLOW_INTERVAL)
+
+def rebuild_cache_from_snapshot():
+    #snapshot is already served, verify it against the filesystem, repos
+    #without snapshot are left to the loader
+    cache_rebuild([ r for r in list(CACHE['index']) if r not in CACHE['pending'] ])
+    rebuild_cache_on_timer()
+
+def configure(
         _storage=None, 
         _storage_local_rootdir=None, 
         _depth=None,
@@ -843,7 +4123,27 @@ def create_app(
         _allow_overwrite=None,
         _auth_anonymous_get=None,
         _chart_url=None,
-        _index_limit=None
+        _index_limit=None,
+        _snapshot=None,
+        _digest_memory_limit=None,
+        _render_delay=None,
+        _index_streaming=None,
+        _watch=None,
+        _watch_delay=None,
+        _shared_dir=None,
+        _writer_socket=None,
+        _follow_leader=None,
+        _follow_user=None,
+        _follow_pass=None,
+        _follow_interval=None,
+        _journal_size=None,
+        _server_timing=None,
+        _profiler=None,
+        _lazy_load=None,
+        _load_timeout=None,
+        _page_limit=None,
+        _fsync=None,
+        _fragment_cache=None
     ):
 
     global CHARTHALL_STORAGE_LOCAL_ROOTDIR
@@ -857,7 +4157,27 @@ def create_app(
     global CHARTHALL_ALLOW_OVERWRITE
     global CHARTHALL_AUTH_ANONYMOUS_GET
     global CHARTHALL_CHART_URL
-    global CHARTHALL_DIGEST_POOL
+    global CHARTHALL_SNAPSHOT
+    global CHARTHALL_INDEX_LIMIT
+    global CHARTHALL_DIGEST_MEMORY_LIMIT
+    global CHARTHALL_RENDER_DELAY
+    global CHARTHALL_INDEX_STREAMING
+    global CHARTHALL_WATCH
+    global CHARTHALL_WATCH_DELAY
+    global CHARTHALL_SHARED_DIR
+    global CHARTHALL_WRITER_SOCKET
+    global CHARTHALL_FOLLOW_LEADER
+    global CHARTHALL_FOLLOW_USER
+    global CHARTHALL_FOLLOW_PASS
+    global CHARTHALL_FOLLOW_INTERVAL
+    global CHARTHALL_JOURNAL_SIZE
+    global CHARTHALL_SERVER_TIMING
+    global CHARTHALL_PROFILER
+    global CHARTHALL_LAZY_LOAD
+    global CHARTHALL_LOAD_TIMEOUT
+    global CHARTHALL_PAGE_LIMIT
+    global CHARTHALL_FSYNC
+    global CHARTHALL_FRAGMENT_CACHE
 
     if _storage_local_rootdir is not None:
         CHARTHALL_STORAGE_LOCAL_ROOTDIR=_storage_local_rootdir
@@ -890,22 +4210,217 @@ def create_app(
         except:
             pass
 
-    CHARTHALL_INDEX_LIMIT=50
+    if _snapshot is not None:
+        try:
+            CHARTHALL_SNAPSHOT = distutils.util.strtobool(_snapshot)
+        except:
+            pass
+
     if _index_limit is not None:
         try:
             CHARTHALL_INDEX_LIMIT=int(_index_limit)
         except:
             pass
 
-    CHARTHALL_DIGEST_POOL=NoDaemonProcessPool(1)
+    if _digest_memory_limit is not None:
+        try:
+            CHARTHALL_DIGEST_MEMORY_LIMIT=parse_size(_digest_memory_limit)
+        except:
+            pass
+
+    if _render_delay is not None:
+        try:
+            CHARTHALL_RENDER_DELAY=float(_render_delay)
+        except:
+            pass
+
+    if _index_streaming is not None:
+        try:
+            CHARTHALL_INDEX_STREAMING = distutils.util.strtobool(_index_streaming)
+        except:
+            pass
+
+    if _watch is not None:
+        try:
+            CHARTHALL_WATCH = distutils.util.strtobool(_watch)
+        except:
+            pass
+
+    if _watch_delay is not None:
+        try:
+            CHARTHALL_WATCH_DELAY=float(_watch_delay)
+        except:
+            pass
+
+    if _shared_dir is not None:
+        CHARTHALL_SHARED_DIR=_shared_dir
+
+    if _writer_socket is not None:
+        CHARTHALL_WRITER_SOCKET=_writer_socket
+
+    if _follow_leader is not None and _follow_leader != '':
+        CHARTHALL_FOLLOW_LEADER=_follow_leader.rstrip('/')
+
+    if _follow_user is not None:
+        CHARTHALL_FOLLOW_USER=_follow_user
+
+    if _follow_pass is not None:
+        CHARTHALL_FOLLOW_PASS=_follow_pass
+
+    if _follow_interval is not None:
+        try:
+            CHARTHALL_FOLLOW_INTERVAL=float(_follow_interval)
+        except:
+            pass
+
+    if _journal_size is not None:
+        try:
+            CHARTHALL_JOURNAL_SIZE=int(_journal_size)
+        except:
+            pass
+
+    if _server_timing is not None:
+        try:
+            CHARTHALL_SERVER_TIMING = distutils.util.strtobool(_server_timing)
+        except:
+            pass
+
+    if _profiler is not None:
+        try:
+            CHARTHALL_PROFILER = distutils.util.strtobool(_profiler)
+        except:
+            pass
+
+    if _lazy_load is not None:
+        try:
+            CHARTHALL_LAZY_LOAD = distutils.util.strtobool(_lazy_load)
+        except:
+            pass
+
+    if _load_timeout is not None:
+        try:
+            CHARTHALL_LOAD_TIMEOUT=float(_load_timeout)
+        except:
+            pass
+
+    if _page_limit is not None:
+        try:
+            CHARTHALL_PAGE_LIMIT=int(_page_limit)
+        except:
+            pass
+
+    if _fsync is not None and _fsync in [ 'always', 'file', 'never' ]:
+        CHARTHALL_FSYNC=_fsync
+
+    if _fragment_cache is not None:
+        try:
+            CHARTHALL_FRAGMENT_CACHE=int(_fragment_cache)
+        except:
+            pass
+
+    rebuild_pool_start(CHARTHALL_INDEX_LIMIT)
+
+def create_app(
+        _storage=None, 
+        _storage_local_rootdir=None, 
+        _depth=None,
+        _chart_post_form_field_name=None,
+        _prov_post_form_field_name=None,        
+        _basic_auth_user=None,
+        _basic_auth_pass=None,
+        _cache_interval=None,
+        _allow_overwrite=None,
+        _auth_anonymous_get=None,
+        _chart_url=None,
+        _index_limit=None,
+        _snapshot=None,
+        _digest_memory_limit=None,
+        _render_delay=None,
+        _index_streaming=None,
+        _watch=None,
+        _watch_delay=None,
+        _shared_dir=None,
+        _writer_socket=None,
+        _follow_leader=None,
+        _follow_user=None,
+        _follow_pass=None,
+        _follow_interval=None,
+        _journal_size=None,
+        _server_timing=None,
+        _profiler=None,
+        _lazy_load=None,
+        _load_timeout=None,
+        _page_limit=None,
+        _fsync=None,
+        _fragment_cache=None
+    ):
+
+    configure(**locals())
+
+    digest_engine_start(CHARTHALL_INDEX_LIMIT, CHARTHALL_DIGEST_MEMORY_LIMIT)
+
+    rebuild_cache_target=rebuild_cache_on_timer
+
+    loaded=[]
+    if CHARTHALL_SNAPSHOT:
+        loaded, missing=snapshot_load_all()
+
+    if len(loaded) > 0:
+        log_print('INFO', 'Serving cache from snapshot')
+        rebuild_cache_target=rebuild_cache_from_snapshot
+
+        if len(missing) > 0:
+            #never served empty, requests wait for them like with LAZY_LOAD
+            loader_start(missing)
+    elif CHARTHALL_LAZY_LOAD:
+        loader_start()
+    else:
+        cache_rebuild()
 
-    cache_rebuild()
     app_build()
 
+    if CHARTHALL_SNAPSHOT:
+        snapshot_writer_thread = threading.Thread(
+            target=snapshot_writer,
+            daemon=True
+        )
+
+        snapshot_writer_thread.start()
+
+    if CHARTHALL_RENDER_DELAY > 0:
+        render_thread = threading.Thread(
+            target=render_on_delay,
+            daemon=True
+        )
+
+        render_thread.start()
+
+    if CHARTHALL_FOLLOW_LEADER is not None:
+        follow_thread = threading.Thread(
+            target=follow_leader,
+            daemon=True
+        )
+
+        follow_thread.start()
+
+    if CHARTHALL_WATCH:
+        watch_thread = threading.Thread(
+            target=watch_filesystem,
+            daemon=True
+        )
+
+        watch_thread.start()
+
     rebuild_cache_thread = threading.Thread(
-        target=rebuild_cache_on_timer
+        target=rebuild_cache_target
     )
 
     rebuild_cache_thread.start()
 
-    return app
\ No newline at end of file
+    return app
+
+def create_reader_app(**_options):
+
+    configure(**_options)
+
+    return reader_app_build()